@@ -1,7 +1,25 @@
+import functools
+import json
+import os
+import subprocess
+import tempfile
+import hashlib
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+
 import bpy
+import numpy as np
 from bpy.types import Operator, Panel, PropertyGroup
-from bpy.props import IntProperty, EnumProperty, BoolProperty, PointerProperty
+from bpy.props import (IntProperty, FloatProperty, FloatVectorProperty, EnumProperty, BoolProperty, PointerProperty,
+                       StringProperty, CollectionProperty)
 from bpy.utils import register_class, unregister_class
+from bpy.app.handlers import persistent
+from mathutils import Matrix
+
+from .curves import KeyStream, reduce_keys, rotations_to_eulers, rotations_to_quaternions
+from .evaluation import isolated_scene, pose_matrices
+from .parallel import run_sample_jobs_steps
 
 bl_info = {
     "name": "loca",
@@ -24,24 +42,1737 @@ axes = [
     ('TRACK_NEGATIVE_Z', '-Z', 'Select  -Z', 5),
 ]
 
-# Global list to store locator names for rotation target
-global locators_RT_name_list
-locators_RT_name_list = []
+# Interpolation and handle type values of baked keys as used by foreach_set
+INTERPOLATION_BEZIER = bpy.types.Keyframe.bl_rna.properties['interpolation'].enum_items['BEZIER'].value
+HANDLE_FREE = bpy.types.Keyframe.bl_rna.properties['handle_left_type'].enum_items['FREE'].value
+HANDLE_AUTO_CLAMPED = bpy.types.Keyframe.bl_rna.properties['handle_left_type'].enum_items['AUTO_CLAMPED'].value
+
+# Keyframe attributes as (name, foreach dtype, values per key) kept when F-curves are rewritten
+KEYFRAME_ATTRIBUTES = (
+    ('co', np.float32, 2),
+    ('handle_left', np.float32, 2),
+    ('handle_right', np.float32, 2),
+    ('handle_left_type', np.int32, 1),
+    ('handle_right_type', np.int32, 1),
+    ('interpolation', np.int32, 1),
+    ('type', np.int32, 1),
+    ('easing', np.int32, 1),
+    ('back', np.float32, 1),
+    ('amplitude', np.float32, 1),
+    ('period', np.float32, 1),
+    ('select_control_point', bool, 1),
+    ('select_left_handle', bool, 1),
+    ('select_right_handle', bool, 1),
+)
+
+# Approximate bytes held per sampled bone and frame while samples are converted to keys
+BAKE_SAMPLE_BYTES = 512
+
+# Approximate bytes held per baked bone and frame by the keys of a window before they are staged
+BAKE_KEY_BYTES = 448
+
+# Spacing of the initial frames of adaptive sampling
+ADAPTIVE_GRID = 8
+
+# Minimum number of frames per background worker of a parallel bake
+PARALLEL_MIN_FRAMES = 100
+
+# Seconds between checks of background workers of a parallel bake
+BAKE_WAIT_INTERVAL = 0.01
+
+# Script run by background Blender processes of a parallel bake
+WORKER_SCRIPT = os.path.join(os.path.dirname(__file__), 'bake_worker.py')
+
+# Sampling policies for baking
+sampling_modes = [
+    ('ALL', 'Every Frame', 'Bake every frame of the range'),
+    ('KEYS', 'Source Keys', 'Bake only frames where the source bones, their parent chains or targets have keys'),
+    ('STEP', 'Step', 'Bake every Nth frame'),
+    ('ADAPTIVE', 'Adaptive', 'Bake only frames where the motion deviates from interpolation'),
+]
+
+# Locator modes stored in the locator registry
+locator_modes = [
+    ('LOCATION', 'Location Target', 'Locator drives the transforms of its source bone'),
+    ('ROTATION', 'Rotation Target', 'Source bone aims at the locator'),
+]
+
+# Channels baked for locators and bake-back
+channel_items = [
+    ('LOCATION', 'Location', 'Bake location'),
+    ('ROTATION', 'Rotation', 'Bake rotation'),
+    ('SCALE', 'Scale', 'Bake scale'),
+]
+
+# Channels of location target locators
+locator_channel_modes = [
+    ('LOCATION', 'Location', 'Locator drives the location of its source bone'),
+    ('LOCATION_ROTATION', 'Location & Rotation', 'Locator drives the location and rotation of its source bone'),
+]
+
+# Channels of a source bone set by the constraints loca adds to it
+constraint_channels = {
+    'COPY_TRANSFORMS': {'LOCATION', 'ROTATION', 'SCALE'},
+    'COPY_LOCATION': {'LOCATION'},
+    'COPY_ROTATION': {'ROTATION'},
+    'DAMPED_TRACK': {'ROTATION'},
+}
+
+# Cached number of locators per armature, read by the panel on every redraw
+locator_cache = {}
+
+# Keys of the F-curves the locators depend on as of their last bake, by action pointer, every entry is
+# (armature name, {locator name: dependency bones}, F-curve count of the action, [(key, F-curve)], {key: (keys, 6)
+# array}) with keys as (bone name, channel, array index), the F-curves are listed again when their count changes
+key_snapshots = {}
 
-# Function to show a message box
+# Profile of the running operator, None while profiling is disabled
+active_profile = None
+
+# Shared no-op context of phases while profiling is disabled
+null_phase = nullcontext()
+
+# Function to show a message box, there is nothing to show it in without a window
 def show_message_box(message="", ttl="Message Box", ic='INFO'):
     def draw(self, context):
         self.layout.label(text=message)
 
-    bpy.context.window_manager.popup_menu(draw, title=ttl, icon=ic)
+    if bpy.context.window is not None:
+        bpy.context.window_manager.popup_menu(draw, title=ttl, icon=ic)
+
+# Function to switch the mode of an armature, works from timers and scripts without a 3D View
+def set_armature_mode(armature, mode):
+    if armature.mode == mode:
+        return
+    with bpy.context.temp_override(active_object=armature, object=armature):
+        bpy.ops.object.mode_set(mode=mode)
+
+# Function to get the selected visible pose bones of an armature without relying on the context of a 3D View
+def selected_pose_bones(armature):
+    selected = []
+    for pose_bone in armature.pose.bones:
+        bone = pose_bone.bone
+        if bone.select and not bone.hide and (
+                not bone.collections or any(collection.is_visible for collection in bone.collections)):
+            selected.append(pose_bone)
+    return selected
+
+# Function to deselect all bones of an armature
+def deselect_bones(armature):
+    bones = armature.data.bones
+    bones.foreach_set('select', np.zeros(len(bones), dtype=bool))
+
+# Function to check whether the active object is an armature in pose mode, used by operators to poll
+def armature_in_pose_mode(context):
+    armature = context.active_object
+    return armature is not None and armature.type == 'ARMATURE' and armature.mode == 'POSE'
+
+# Profile of one operator run, records phases as trace events and counts operator calls and evaluations
+class LocaProfile:
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.events = []
+        self.phase_times = {}
+        self.counters = {'ops': 0, 'mode_switches': 0, 'depsgraph_updates': 0, 'frame_changes': 0}
+        self.op_call = None
+
+    def phase(self, name):
+        return LocaPhase(self, name)
+
+    def count(self, counter):
+        self.counters[counter] += 1
+
+    def add_phase(self, name, start, end):
+        self.phase_times[name] = self.phase_times.get(name, 0.0) + end - start
+        pid = os.getpid()
+        self.events.append({'name': name, 'cat': 'loca', 'ph': 'X', 'pid': pid, 'tid': 0,
+                            'ts': (start - self.start) * 1e6, 'dur': (end - start) * 1e6})
+        self.events.append({'name': 'counters', 'ph': 'C', 'pid': pid, 'tid': 0,
+                            'ts': (end - self.start) * 1e6, 'args': dict(self.counters)})
+
+    # Function to write the profile in the Trace Event Format of chrome://tracing and Perfetto
+    def write_trace(self, path):
+        total = time.perf_counter() - self.start
+        events = [{'name': self.name, 'cat': 'loca', 'ph': 'X', 'pid': os.getpid(), 'tid': 0, 'ts': 0.0,
+                   'dur': total * 1e6, 'args': dict(self.counters)}] + self.events
+        with open(path, 'w') as trace:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace)
+
+    def summary(self):
+        total = time.perf_counter() - self.start
+        counters = self.counters
+        phases = ', '.join(f"{name} {seconds:.3f}s" for name, seconds in
+                           sorted(self.phase_times.items(), key=lambda item: -item[1]))
+        return (f"{self.name}: {total:.3f}s, {counters['ops']} operator calls "
+                f"({counters['mode_switches']} mode switches), {counters['depsgraph_updates']} depsgraph updates, "
+                f"{counters['frame_changes']} frame changes; {phases}")
+
+# Context of one timed phase of a profile
+class LocaPhase:
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profile.add_phase(self.name, self.start, time.perf_counter())
+        return False
+
+# Function to get the context of a phase of the running profile, a shared no-op context without profiling
+def profile_phase(name):
+    profile = active_profile
+    return null_phase if profile is None else profile.phase(name)
+
+# Handler to count depsgraph updates of the running profile
+def loca_profile_depsgraph_update(scene, depsgraph):
+    if active_profile is not None:
+        active_profile.count('depsgraph_updates')
+
+# Handler to count frame changes of the running profile
+def loca_profile_frame_change(scene, depsgraph):
+    if active_profile is not None:
+        active_profile.count('frame_changes')
+
+# Function to start profiling an operator if profiling is enabled, returns whether a profile was started,
+# operator calls are counted by wrapping the call of bpy.ops operators for the duration of the profile
+def profile_begin(context, name):
+    global active_profile
+    if active_profile is not None or not context.scene.loca.profile:
+        return False
+    profile = LocaProfile(name)
+    op_type = type(bpy.ops.object.mode_set)
+    op_call = op_type.__call__
+
+    def counted_call(op, *args, **kwargs):
+        profile.count('ops')
+        if op.idname_py() == 'object.mode_set':
+            profile.count('mode_switches')
+        return op_call(op, *args, **kwargs)
+
+    profile.op_call = op_call
+    op_type.__call__ = counted_call
+    bpy.app.handlers.depsgraph_update_post.append(loca_profile_depsgraph_update)
+    bpy.app.handlers.frame_change_post.append(loca_profile_frame_change)
+    active_profile = profile
+    return True
+
+# Function to stop the running profile, report its summary and write its trace
+def profile_end(operator, context):
+    global active_profile
+    profile = active_profile
+    if profile is None:
+        return
+    active_profile = None
+    type(bpy.ops.object.mode_set).__call__ = profile.op_call
+    bpy.app.handlers.depsgraph_update_post.remove(loca_profile_depsgraph_update)
+    bpy.app.handlers.frame_change_post.remove(loca_profile_frame_change)
+
+    trace_path = bpy.path.abspath(context.scene.loca.profile_path)
+    if not bpy.data.filepath and context.scene.loca.profile_path.startswith('//'):
+        trace_path = os.path.join(tempfile.gettempdir(), context.scene.loca.profile_path[2:])
+    try:
+        profile.write_trace(trace_path)
+        operator.report({'INFO'}, f"{profile.summary()}; trace written to {trace_path}")
+    except OSError as error:
+        operator.report({'WARNING'}, f"{profile.summary()}; trace not written: {error}")
+
+# Decorator to profile the execute method of an operator
+def profiled(method):
+    @functools.wraps(method)
+    def wrapper(self, context, *args):
+        if not profile_begin(context, self.bl_idname):
+            return method(self, context, *args)
+        try:
+            return method(self, context, *args)
+        finally:
+            profile_end(self, context)
+    return wrapper
+
+# Function to index F-curves of pose bones by (bone name, channel), data paths are parsed only once
+def fcurve_index(action):
+    index = {}
+    if action is None:
+        return index
+    for fcurve in action.fcurves:
+        data_path = fcurve.data_path
+        if data_path.startswith('pose.bones["'):
+            bone_name, _, channel = data_path[12:].partition('"].')
+            index.setdefault((bone_name, channel), []).append(fcurve)
+    return index
+
+# Function to get the F-curve index of the action of an armature
+def armature_fcurve_index(armature):
+    action = armature.animation_data.action if armature.animation_data else None
+    with profile_phase('index F-curves'):
+        return fcurve_index(action)
+
+# Function to get all indexed F-curves of the given bones
+def bone_fcurves(index, bone_names):
+    bone_names = set(bone_names)
+    return [fcurve for (bone_name, _), fcurves in index.items() if bone_name in bone_names for fcurve in fcurves]
+
+# Function to get the locator registry of an armature as a dictionary by locator name
+def locator_registry(armature):
+    return {locator.name: locator for locator in armature.data.loca_locators}
+
+# Function to get the cached number of locators which still exist in the armature
+def locator_count(armature):
+    key = armature.data.as_pointer()
+    count = locator_cache.get(key)
+    if count is None:
+        bones = armature.data.bones
+        count = sum(1 for locator in armature.data.loca_locators if locator.name in bones)
+        locator_cache[key] = count
+    return count
+
+# Function to invalidate the cached locator state of an armature
+def invalidate_locator_cache(armature):
+    locator_cache.pop(armature.data.as_pointer(), None)
+
+# Handler to invalidate the cached locator state when bones of an armature change
+# and to mark the frames of locators whose source animation was edited as dirty
+@persistent
+def loca_depsgraph_update(scene, depsgraph):
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Armature):
+            locator_cache.pop(update.id.original.as_pointer(), None)
+        elif isinstance(update.id, bpy.types.Action):
+            snapshot = key_snapshots.get(update.id.original.as_pointer())
+            armature = bpy.data.objects.get(snapshot[0]) if snapshot else None
+            if armature is not None and armature.type == 'ARMATURE':
+                mark_dirty_locators(armature, snapshot)
+
+# Handler to drop the cached locator state of the previous file and take the key snapshots of the new one,
+# the bake cache is replaced by the sidecar file of the new one
+@persistent
+def loca_load_post(dummy):
+    locator_cache.clear()
+    key_snapshots.clear()
+    for ob in bpy.data.objects:
+        if ob.type == 'ARMATURE' and ob.data.loca_locators:
+            snapshot_locator_sources(ob)
+    bake_cache.clear()
+    pose_sample_cache.clear()
+    path = bake_cache_path()
+    if path and os.path.exists(path):
+        try:
+            bake_cache.load(path)
+        except (OSError, ValueError):
+            bake_cache.clear()
+
+# Handler to store the bake cache in a sidecar file next to the saved blend file
+@persistent
+def loca_save_post(dummy):
+    path = bake_cache_path()
+    if path and bake_cache.entries:
+        try:
+            bake_cache.save(path)
+        except OSError:
+            pass
+
+# Function to add a record to the locator registry
+def register_locator(armature, locator_name, bone_name, mode, st_frame, end_frame, channels):
+    invalidate_locator_cache(armature)
+    locator = armature.data.loca_locators.add()
+    locator.name = locator_name
+    locator.bone = bone_name
+    locator.mode = mode
+    locator.channels = channels
+    locator.frame_start = st_frame
+    locator.frame_end = end_frame
+    return locator
+
+# Function to remove records from the locator registry
+def unregister_locators(armature, locator_names):
+    invalidate_locator_cache(armature)
+    locators = armature.data.loca_locators
+    for i in reversed(range(len(locators))):
+        if locators[i].name in locator_names:
+            locators.remove(i)
+
+# Function to delete locator bones in a single edit mode pass
+def delete_locator_bones(armature, locator_names):
+    locator_names = set(locator_names)
+    if not locator_names:
+        return
+    invalidate_locator_cache(armature)
+    with profile_phase('delete locators'):
+        set_armature_mode(armature, 'EDIT')
+        edit_bones = armature.data.edit_bones
+        for bone in [bone for bone in edit_bones if bone.name in locator_names]:
+            edit_bones.remove(bone)
+        set_armature_mode(armature, 'POSE')
+
+# Function to ensure the armature has an action to receive baked keys
+def ensure_action(armature):
+    if not armature.animation_data:
+        armature.animation_data_create()
+    if not armature.animation_data.action:
+        armature.animation_data.action = bpy.data.actions.new(f'{armature.name}Action')
+    return armature.animation_data.action
+
+# Function to write keys of one F-curve in bulk, replacing existing keys inside the baked range,
+# handles are (keys, 2) arrays of free handles, keys without them get auto clamped handles
+def write_fcurve_keys(action, index, bone_name, data_path, array_index, frames, values,
+                      handles_left=None, handles_right=None):
+    fcurves = index.setdefault((bone_name, data_path), [])
+    fcurve = next((fcurve for fcurve in fcurves if fcurve.array_index == array_index), None)
+    if fcurve is None:
+        fcurve = action.fcurves.new(f'pose.bones["{bone_name}"].{data_path}', index=array_index,
+                                    action_group=bone_name)
+        fcurves.append(fcurve)
+    keyframe_points = fcurve.keyframe_points
+
+    new_count = len(frames)
+    new_co = np.empty((new_count, 2), dtype=np.float32)
+    new_co[:, 0] = frames
+    new_co[:, 1] = values
+    new_data = {
+        'co': new_co,
+        'handle_left': new_co if handles_left is None else handles_left,
+        'handle_right': new_co if handles_right is None else handles_right,
+        'handle_left_type': np.full(new_count, HANDLE_AUTO_CLAMPED if handles_left is None else HANDLE_FREE),
+        'handle_right_type': np.full(new_count, HANDLE_AUTO_CLAMPED if handles_right is None else HANDLE_FREE),
+        'interpolation': np.full(new_count, INTERPOLATION_BEZIER),
+    }
+
+    # Existing keys outside the baked range are kept with all their attributes, the curve is rebuilt at once
+    old_count = len(keyframe_points)
+    kept_data = {}
+    for attribute, dtype, width in KEYFRAME_ATTRIBUTES if old_count else ():
+        kept_data[attribute] = np.empty((old_count, width), dtype=dtype)
+        keyframe_points.foreach_get(attribute, kept_data[attribute].ravel())
+    if old_count:
+        old_frames = kept_data['co'][:, 0]
+        kept = (old_frames < frames[0]) | (old_frames > frames[-1])
+        kept_data = {attribute: old_values[kept] for attribute, old_values in kept_data.items()}
+        keyframe_points.clear()
+    kept_count = len(kept_data['co']) if kept_data else 0
+
+    keyframe_points.add(kept_count + new_count)
+    for attribute, dtype, width in KEYFRAME_ATTRIBUTES:
+        if attribute not in new_data and not kept_count:
+            continue
+        all_values = np.empty((kept_count + new_count, width), dtype=dtype)
+        if attribute in new_data:
+            all_values[kept_count:] = np.reshape(new_data[attribute], (new_count, width))
+        else:
+            # New keys keep the defaults of added keyframes for attributes the bake does not set
+            keyframe_points.foreach_get(attribute, all_values.ravel())
+        if kept_count:
+            all_values[:kept_count] = kept_data[attribute]
+        keyframe_points.foreach_set(attribute, all_values.ravel())
+    fcurve.update()
+    return fcurve
+
+# Function to get key reduction tolerances per channel from addon properties, None if disabled
+def key_reduction(props):
+    if not props.reduce_keys:
+        return None
+    return {
+        'location': ('DISTANCE', props.reduce_location_tolerance),
+        'scale': ('DISTANCE', props.reduce_location_tolerance),
+        'rotation_quaternion': ('QUATERNION', props.reduce_rotation_tolerance),
+        'rotation_euler': ('EULER', props.reduce_rotation_tolerance),
+        'rotation_axis_angle': ('EULER', props.reduce_rotation_tolerance),
+    }
+
+# Function to write baked channels of a bone, channels map data paths to (frames, components) arrays,
+# keys are reduced within the given tolerances per channel
+def write_bone_keys(armature, index, bone_name, frames, channels, reduction=None):
+    action = ensure_action(armature)
+    for data_path, values in channels.items():
+        if reduction and data_path in reduction and len(frames) > 2:
+            metric, tolerance = reduction[data_path]
+            key_frames, key_values, handles_left, handles_right = reduce_keys(frames, values, tolerance, metric)
+            for array_index in range(values.shape[1]):
+                write_fcurve_keys(action, index, bone_name, data_path, array_index, key_frames,
+                                  key_values[:, array_index], handles_left[:, array_index],
+                                  handles_right[:, array_index])
+        else:
+            for array_index in range(values.shape[1]):
+                write_fcurve_keys(action, index, bone_name, data_path, array_index, frames, values[:, array_index])
+
+# Keys of a bake streamed window by window, spilled to a temporary file in chunks until write moves the keys
+# of a bone to the armature, so the animation being sampled stays unchanged during the bake and only the keys
+# of one channel are held in memory at once. Keys are staged as float32 rows of frame, values and handles,
+# the precision F-curves keep them in anyway
+class StagedBake:
+    def __init__(self, reduction=None):
+        self.reduction = reduction
+        self.streams = {}
+        # Chunks per (bone name, data path) as [file offset, rows], layouts as (components, has handles)
+        self.chunks = {}
+        self.layouts = {}
+        self.bone_names = {}
+        self.file = tempfile.TemporaryFile(prefix='loca_staged_')
+        self.size = 0
+
+    # Function to append keys computed for a window as (bone name, frames, channels)
+    def append(self, baked, final=False):
+        for bone_name, frames, channels in baked:
+            self.bone_names[bone_name] = None
+            for data_path, values in channels.items():
+                key = (bone_name, data_path)
+                stream = self.streams.get(key)
+                if stream is None:
+                    reduction = self.reduction.get(data_path) if self.reduction else None
+                    stream = self.streams[key] = KeyStream(reduction)
+                    self.chunks[key] = []
+                keys = stream.append(frames, values, final)
+                if keys is None:
+                    continue
+                key_frames, key_values, handles_left, handles_right = keys
+                self.layouts[key] = (key_values.shape[1], handles_left is not None)
+                columns = [key_frames[:, None], key_values]
+                if handles_left is not None:
+                    columns += [handles_left.reshape(len(key_frames), -1),
+                                handles_right.reshape(len(key_frames), -1)]
+                rows = np.concatenate(columns, axis=1).astype(np.float32)
+
+                # The first key of a window replaces the last key staged before
+                chunks = self.chunks[key]
+                if chunks:
+                    chunks[-1][1] -= 1
+                self.file.seek(self.size)
+                self.file.write(rows.tobytes())
+                chunks.append([self.size, len(rows)])
+                self.size += rows.nbytes
+
+    # Function to write the staged keys of a bone to the armature, the staging file is closed after the last bone
+    def write(self, armature, index, bone_name):
+        action = ensure_action(armature)
+        self.file.flush()
+        for key in [key for key in self.chunks if key[0] == bone_name]:
+            chunks = self.chunks.pop(key)
+            if not chunks:
+                continue
+            components, has_handles = self.layouts[key]
+            columns = 1 + components * (5 if has_handles else 1)
+            rows = []
+            for offset, count in chunks:
+                self.file.seek(offset)
+                rows.append(np.frombuffer(self.file.read(count * columns * 4), dtype=np.float32))
+            rows = np.concatenate(rows).reshape(-1, columns)
+
+            key_frames, key_values = rows[:, 0], rows[:, 1:1 + components]
+            if has_handles:
+                handles_left = rows[:, 1 + components:1 + components * 3].reshape(-1, components, 2)
+                handles_right = rows[:, 1 + components * 3:].reshape(-1, components, 2)
+            for array_index in range(components):
+                write_fcurve_keys(action, index, bone_name, key[1], array_index, key_frames,
+                                  key_values[:, array_index],
+                                  handles_left[:, array_index] if has_handles else None,
+                                  handles_right[:, array_index] if has_handles else None)
+        if not self.chunks:
+            self.file.close()
+
+# Function to run bake steps to the end and return their result, steps yield None after every baked frame
+# or the number of frames background workers finished while they are waited for
+def run_bake_steps(steps):
+    while True:
+        try:
+            if next(steps) is not None:
+                time.sleep(BAKE_WAIT_INTERVAL)
+        except StopIteration as stop:
+            return stop.value
+
+# Function to start a background Blender process working on a bake job, launchers take the snapshot
+# and job file paths and return a Popen-like process, so a local Python stand-in can replace Blender
+def blender_worker_launcher(snapshot, job_path):
+    autoexec = '-y' if bpy.context.preferences.filepaths.use_scripts_auto_execute else '-Y'
+    with open(f'{job_path}.log', 'w') as log:
+        return subprocess.Popen([bpy.app.binary_path, '-b', autoexec, snapshot, '--python', WORKER_SCRIPT,
+                                 '--', job_path], stdout=log, stderr=subprocess.STDOUT)
+
+# Generator to sample pose matrices in background processes, every worker evaluates one chunk of the frames
+# on a snapshot of the file and returns its samples through a memory-mapped .npy file, yields the number of
+# frames the workers finished while waiting for them
+def sample_pose_matrices_parallel_steps(scene, armature, bone_names, frames, workers, launcher=None):
+    launcher = launcher or blender_worker_launcher
+    objects = isolated_objects(scene, armature) if scene.loca.isolated_evaluation else None
+
+    with tempfile.TemporaryDirectory(prefix='loca_bake_') as directory:
+        snapshot = os.path.join(directory, 'snapshot.blend')
+        bpy.data.libraries.write(snapshot, {scene}, path_remap='ABSOLUTE', fake_user=True)
+
+        job = {
+            'scene': scene.name,
+            'objects': [ob.name for ob in objects] if objects else None,
+            'view_layer': bpy.context.view_layer.name if bpy.context.view_layer else scene.view_layers[0].name,
+            'armature': armature.name,
+            'bones': list(bone_names),
+        }
+        return (yield from run_sample_jobs_steps(directory, snapshot, job, frames, workers, launcher))
+
+# Function to get the objects referenced by Object pointers of a constraint or modifier
+def object_pointers(struct):
+    return [getattr(struct, prop.identifier) for prop in struct.bl_rna.properties
+            if prop.type == 'POINTER' and prop.fixed_type.identifier == 'Object']
+
+# Function to get the armature and all objects its evaluation depends on through parents, constraints,
+# modifiers and driver variables, or None when the scene simulates rigid bodies which only evaluate in their scene
+def isolated_objects(scene, armature):
+    found = set()
+    stack = [armature]
+    while stack:
+        ob = stack.pop()
+        if ob is None or ob in found:
+            continue
+        found.add(ob)
+        stack.append(ob.parent)
+        constraints = list(ob.constraints)
+        if ob.pose:
+            constraints += [constraint for bone in ob.pose.bones for constraint in bone.constraints]
+        for constraint in constraints:
+            if constraint.mute:
+                continue
+            stack += object_pointers(constraint)
+            # Armature constraints keep their targets in a collection
+            stack += [target.target for target in getattr(constraint, 'targets', ())]
+        for modifier in ob.modifiers:
+            stack += object_pointers(modifier)
+        for data in (ob, ob.data):
+            animation_data = getattr(data, 'animation_data', None)
+            if not animation_data:
+                continue
+            for fcurve in animation_data.drivers:
+                for variable in fcurve.driver.variables:
+                    stack += [target.id for target in variable.targets if isinstance(target.id, bpy.types.Object)]
+    if scene.rigidbody_world and any(ob.rigid_body for ob in found):
+        return None
+    return found
+
+# Generator to read pose space matrices of several bones for a list of frames, frames found in the
+# sample cache for all bones are not evaluated again, yields after every evaluated frame and returns
+# the (frames, bones, 4, 4) samples
+def sample_pose_matrices_steps(scene, armature, bone_names, frames, index=None):
+    frames = np.asarray(frames, dtype=int)
+    if index is None:
+        index = armature_fcurve_index(armature)
+    keys = pose_sample_keys(scene, armature, bone_names, index)
+    samples = np.empty((len(frames), len(bone_names), 4, 4))
+    missing = np.ones(len(frames), dtype=bool) if len(keys) < len(bone_names) else np.zeros(len(frames), dtype=bool)
+    for i, bone_name in enumerate(bone_names):
+        if bone_name in keys:
+            found, matrices = pose_sample_cache.lookup(keys[bone_name], frames)
+            samples[found, i] = matrices
+            missing |= ~found
+    if not missing.any():
+        return samples
+
+    evaluated_frames = frames[missing]
+    evaluated = yield from evaluate_pose_matrices_steps(scene, armature, bone_names, evaluated_frames)
+    samples[missing] = evaluated
+    max_size = scene.loca.sample_cache_size * 1024 * 1024
+    for i, bone_name in enumerate(bone_names):
+        if bone_name in keys:
+            pose_sample_cache.store(keys[bone_name], evaluated_frames, evaluated[:, i], max_size)
+    return samples
+
+# Generator to evaluate pose space matrices of several bones for a list of frames in a single sweep,
+# yields after every evaluated frame and returns the (frames, bones, 4, 4) samples
+def evaluate_pose_matrices_steps(scene, armature, bone_names, frames):
+    workers = scene.loca.bake_workers
+    if workers > 1 and len(frames) >= workers * PARALLEL_MIN_FRAMES:
+        return (yield from sample_pose_matrices_parallel_steps(scene, armature, bone_names, frames, workers))
+
+    frame_current = scene.frame_current
+    bone_index = {bone.name: i for i, bone in enumerate(armature.pose.bones)}
+    indices = [bone_index[name] for name in bone_names]
+    buffer = np.empty(len(bone_index) * 16, dtype=np.float32)
+    samples = np.empty((len(frames), len(indices), 4, 4))
+
+    objects = isolated_objects(scene, armature) if scene.loca.isolated_evaluation else None
+    evaluation_scene = isolated_scene(scene, objects) if objects else scene
+    try:
+        if objects:
+            depsgraph = evaluation_scene.view_layers[0].depsgraph
+        for i, frame in enumerate(frames):
+            evaluation_scene.frame_set(int(frame))
+            pose_bones = armature.evaluated_get(depsgraph).pose.bones if objects else armature.pose.bones
+            samples[i] = pose_matrices(pose_bones, buffer)[indices]
+            yield
+    finally:
+        # The scene of the file never left its frame when only the isolated scene was evaluated
+        if objects:
+            bpy.data.scenes.remove(evaluation_scene)
+        else:
+            scene.frame_set(frame_current)
+    return samples
+
+# Function to convert pose space matrices of a bone into its local (basis) matrices
+def pose_to_local(armature, bone_name, pose_matrices, parent_matrices=None):
+    bone = armature.data.bones[bone_name]
+    rest = np.array(bone.matrix_local)
+    if bone.parent is None:
+        if bone.use_local_location:
+            return np.linalg.inv(rest) @ pose_matrices
+        # Locations in armature space are resolved by Blender frame by frame
+        return np.array([bone.convert_local_to_pose(Matrix(pose), bone.matrix_local, invert=True)
+                         for pose in pose_matrices])
+
+    parent_rest = np.array(bone.parent.matrix_local)
+    if bone.use_inherit_rotation and bone.inherit_scale == 'FULL' and bone.use_local_location:
+        rest_offset = np.linalg.inv(parent_rest) @ rest
+        return np.linalg.inv(rest_offset) @ np.linalg.inv(parent_matrices) @ pose_matrices
+
+    # Other inheritance options are resolved by Blender frame by frame
+    return np.array([
+        bone.convert_local_to_pose(Matrix(pose), bone.matrix_local, parent_matrix=Matrix(parent),
+                                   parent_matrix_local=bone.parent.matrix_local, invert=True)
+        for pose, parent in zip(pose_matrices, parent_matrices)])
+
+# Function to split local matrices of a pose bone into its animation channels for all frames at once
+def matrices_to_channels(pose_bone, matrices, channel_mask=None, continuity=None):
+    channel_mask = channel_mask or constraint_channels['COPY_TRANSFORMS']
+    basis = matrices[:, :3, :3]
+    scale = np.linalg.norm(basis, axis=1)
+    scale[np.linalg.det(basis) < 0] *= -1
+    rotations = basis / scale[:, None, :]
+    channels = {}
+    if 'LOCATION' in channel_mask:
+        channels['location'] = matrices[:, :3, 3]
+    if 'SCALE' in channel_mask:
+        channels['scale'] = scale
+    if 'ROTATION' not in channel_mask:
+        return channels
+
+    if pose_bone.rotation_mode == 'QUATERNION':
+        channels['rotation_quaternion'] = rotations_to_quaternions(rotations, continuity)
+    elif pose_bone.rotation_mode == 'AXIS_ANGLE':
+        axis_angles = []
+        for rotation in rotations:
+            axis, angle = Matrix(rotation).to_quaternion().to_axis_angle()
+            axis_angles.append((angle, *axis))
+        channels['rotation_axis_angle'] = np.array(axis_angles)
+    else:
+        channels['rotation_euler'] = rotations_to_eulers(rotations, pose_bone.rotation_mode, continuity)
+    return channels
+
+# Function to read the current pose space matrices of all pose bones, returns them with an index by bone name
+def read_pose_matrices(armature):
+    bone_index = {bone.name: i for i, bone in enumerate(armature.pose.bones)}
+    buffer = np.empty(len(bone_index) * 16, dtype=np.float32)
+    return bone_index, pose_matrices(armature.pose.bones, buffer).astype(np.float64)
+
+# Function to set the transforms of bones without parents so that they reach the given pose space matrices,
+# all bones are converted together and every channel is written with one foreach_set
+def set_root_pose_matrices(armature, bone_names, pose_matrices):
+    pose_bones = armature.pose.bones
+    bone_index = {bone.name: i for i, bone in enumerate(pose_bones)}
+    rests = np.array([np.array(armature.data.bones[bone_name].matrix_local) for bone_name in bone_names])
+    local = np.linalg.inv(rests) @ pose_matrices
+
+    # Bones with the same rotation mode are converted together
+    groups = {}
+    for i, bone_name in enumerate(bone_names):
+        groups.setdefault(pose_bones[bone_name].rotation_mode, []).append(i)
+    values = {}
+    for members in groups.values():
+        channels = matrices_to_channels(pose_bones[bone_names[members[0]]], local[members])
+        rows = [bone_index[bone_names[i]] for i in members]
+        for data_path, channel_values in channels.items():
+            values.setdefault(data_path, []).append((rows, channel_values))
+
+    for data_path, parts in values.items():
+        width = parts[0][1].shape[1]
+        buffer = np.empty(len(pose_bones) * width, dtype=np.float32)
+        pose_bones.foreach_get(data_path, buffer)
+        buffer = buffer.reshape(-1, width)
+        for rows, channel_values in parts:
+            buffer[rows] = channel_values
+        pose_bones.foreach_set(data_path, buffer.ravel())
+    armature.update_tag()
+
+# Function to get the bones moved by IK and Spline IK constraints with the owners of the constraints moving
+# them, chains reach from the owners over their parents within the chain length, 0 reaches the root
+def ik_chain_bones(armature):
+    owners = {}
+    for pose_bone in armature.pose.bones:
+        for constraint in pose_bone.constraints:
+            if constraint.mute or constraint.type not in ('IK', 'SPLINE_IK'):
+                continue
+            bone = pose_bone.bone
+            count = constraint.chain_count
+            while bone is not None and (count > 0 or constraint.chain_count == 0):
+                owners.setdefault(bone.name, set()).add(pose_bone.name)
+                bone = bone.parent
+                count -= 1
+    return owners
+
+# Function to collect bones whose animation drives the given bones: parent chains, constraint targets and
+# the owners of IK chains the bones belong to, ik_owners is the result of ik_chain_bones if already known
+def dependency_bones(armature, bone_names, ik_owners=None):
+    if ik_owners is None:
+        ik_owners = ik_chain_bones(armature)
+    bones = armature.data.bones
+    pose_bones = armature.pose.bones
+    found = set()
+    stack = list(bone_names)
+    while stack:
+        bone_name = stack.pop()
+        if bone_name in found or bone_name not in bones:
+            continue
+        found.add(bone_name)
+        if bones[bone_name].parent:
+            stack.append(bones[bone_name].parent.name)
+        stack += ik_owners.get(bone_name, ())
+        for constraint in pose_bones[bone_name].constraints:
+            if constraint.mute:
+                continue
+            if getattr(constraint, 'target', None) == armature and getattr(constraint, 'subtarget', ''):
+                stack.append(constraint.subtarget)
+            if getattr(constraint, 'pole_target', None) == armature and getattr(constraint, 'pole_subtarget', ''):
+                stack.append(constraint.pole_subtarget)
+    return found
+
+# Function to get the locators which were baked from their source bones and follow their animation
+def baked_locators(armature):
+    bones = armature.data.bones
+    return [locator for locator in armature.data.loca_locators
+            if not locator.pending and locator.constraints and locator.name in bones and locator.bone in bones]
+
+# Function to get the bones whose animation a baked locator depends on, the locators themselves excluded
+def locator_dependencies(armature, locator, ik_owners=None):
+    return dependency_bones(armature, [locator.bone], ik_owners) - set(armature.data.loca_locators.keys())
+
+# Function to read the keys of an F-curve with their handles as a (keys, 6) array
+def fcurve_keys(fcurve):
+    points = fcurve.keyframe_points
+    keys = np.empty((3, len(points) * 2), dtype=np.float32)
+    points.foreach_get('co', keys[0])
+    points.foreach_get('handle_left', keys[1])
+    points.foreach_get('handle_right', keys[2])
+    return keys.reshape(3, -1, 2).transpose(1, 0, 2).reshape(-1, 6)
+
+# Function to get the frame span changed between two versions of the keys of an F-curve, a change reaches
+# from the previous to the next unchanged key, changes of the first or last key reach into the extrapolation
+def changed_key_span(old, new):
+    if old.shape == new.shape and np.array_equal(old, new):
+        return None
+    common = min(len(old), len(new))
+    differs = np.flatnonzero((old[:common] != new[:common]).any(axis=1))
+    first = differs[0] if len(differs) else common
+    differs = np.flatnonzero((old[::-1][:common] != new[::-1][:common]).any(axis=1))
+    suffix = min(differs[0] if len(differs) else common, common - first)
+    start = old[first - 1, 0] if first else -np.inf
+    end = old[len(old) - suffix, 0] if suffix else np.inf
+    return start, end
+
+# Function to add a dirty frame span to a locator, overlapping and adjacent spans are merged
+def add_dirty_span(locator, st_frame, end_frame):
+    spans = sorted([(span.frame_start, span.frame_end) for span in locator.dirty] + [(st_frame, end_frame)])
+    merged = [spans[0]]
+    for start, end in spans[1:]:
+        if start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    locator.dirty.clear()
+    for start, end in merged:
+        span = locator.dirty.add()
+        span.frame_start = start
+        span.frame_end = end
+
+# Function to list the F-curves of the given bones as ((bone name, channel, array index), F-curve)
+def dependency_fcurves(action, bones):
+    return [((bone_name, channel, fcurve.array_index), fcurve)
+            for (bone_name, channel), fcurves in fcurve_index(action).items() if bone_name in bones
+            for fcurve in fcurves]
+
+# Function to store the keys of the F-curves the baked locators of an armature depend on
+def snapshot_locator_sources(armature):
+    action = armature.animation_data.action if armature.animation_data else None
+    if action is None:
+        return
+    ik_owners = ik_chain_bones(armature)
+    dependencies = {locator.name: locator_dependencies(armature, locator, ik_owners)
+                    for locator in baked_locators(armature)}
+    bones = set().union(*dependencies.values())
+    if not bones:
+        key_snapshots.pop(action.as_pointer(), None)
+        return
+    fcurves = dependency_fcurves(action, bones)
+    key_snapshots[action.as_pointer()] = (armature.name, dependencies, len(action.fcurves), fcurves,
+                                          {key: fcurve_keys(fcurve) for key, fcurve in fcurves})
+
+# Function to compare the keys the baked locators depend on with their snapshot and mark the frames
+# of the locators affected by edited keys as dirty, only the F-curves listed by the snapshot are read
+def mark_dirty_locators(armature, snapshot):
+    action = armature.animation_data.action if armature.animation_data else None
+    if action is None:
+        return
+    armature_name, dependencies, fcurve_count, fcurves, keys = snapshot
+    if len(action.fcurves) != fcurve_count:
+        fcurve_count = len(action.fcurves)
+        fcurves = dependency_fcurves(action, set().union(*dependencies.values()))
+    registry = locator_registry(armature)
+    locators = [(registry[name], bones) for name, bones in dependencies.items() if name in registry]
+    current = {key: fcurve_keys(fcurve) for key, fcurve in fcurves}
+    key_snapshots[action.as_pointer()] = (armature_name, dependencies, fcurve_count, fcurves, current)
+
+    bone_spans = {}
+    empty = np.empty((0, 6), dtype=np.float32)
+    for key in current.keys() | keys.keys():
+        span = changed_key_span(keys.get(key, empty), current.get(key, empty))
+        if span is not None:
+            bone_spans.setdefault(key[0], []).append(span)
+    if not bone_spans:
+        return
+
+    for locator, bones in locators:
+        for bone_name in bones & bone_spans.keys():
+            for start, end in bone_spans[bone_name]:
+                st_frame = max(locator.frame_start, int(np.floor(max(start, locator.frame_start))))
+                end_frame = min(locator.frame_end, int(np.ceil(min(end, locator.frame_end))))
+                if st_frame <= end_frame:
+                    add_dirty_span(locator, st_frame, end_frame)
+
+# Least recently used cache of baked keys by fingerprint of the bake inputs, limited by the size of its arrays,
+# entries are (frames, channels, size in bytes)
+class BakeCache:
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, frames, channels, max_size):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[2]
+        size = frames.nbytes + sum(values.nbytes for values in channels.values())
+        if size > max_size:
+            return
+        self.entries[key] = (frames, channels, size)
+        self.size += size
+        while self.size > max_size:
+            self.size -= self.entries.popitem(last=False)[1][2]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    # Function to write all entries to a .npz file, least recently used first
+    def save(self, path):
+        arrays = {}
+        for key, (frames, channels, _) in self.entries.items():
+            arrays[f'{key}:frames'] = frames
+            for data_path, values in channels.items():
+                arrays[f'{key}:{data_path}'] = values
+        with open(path, 'wb') as cache_file:
+            np.savez(cache_file, **arrays)
+
+    def load(self, path):
+        entries = OrderedDict()
+        with np.load(path) as data:
+            for name in data.files:
+                key, _, field = name.partition(':')
+                entries.setdefault(key, {})[field] = data[name]
+        for key, fields in entries.items():
+            frames = fields.pop('frames')
+            self.put(key, frames, fields, np.inf)
+
+
+bake_cache = BakeCache()
+
+# Function to get the sidecar file of the bake cache, None for unsaved files
+def bake_cache_path():
+    if not bpy.data.filepath:
+        return None
+    return f'{os.path.splitext(bpy.data.filepath)[0]}.loca_cache.npz'
+
+# Function to get the settings of an RNA struct as a string, pointers are represented by their names
+def rna_settings(struct):
+    settings = []
+    for prop in struct.bl_rna.properties:
+        if prop.identifier in ('rna_type', 'active', 'show_expanded') or prop.type == 'COLLECTION':
+            continue
+        value = getattr(struct, prop.identifier)
+        if prop.type == 'POINTER':
+            value = getattr(value, 'name', None)
+        elif getattr(prop, 'array_length', 0):
+            value = np.array(value).tolist()
+        settings.append((prop.identifier, value))
+    return repr(settings)
+
+# Function to check whether the pose of an armature only depends on its bones, constraints and action
+def pose_cacheable(armature):
+    animation_data = armature.animation_data
+    return not (animation_data and (animation_data.drivers or any(not track.mute for track in animation_data.nla_tracks)))
+
+# Function to get a digest of the inputs of the animation of one bone: its rest pose, inheritance, rotation mode,
+# constraints, F-curves and the values of channels without F-curves, returns None if inputs outside of these
+# may change the animation
+def bone_inputs_digest(armature, bone_name, index):
+    fingerprint = hashlib.blake2b(digest_size=20)
+    bone = armature.data.bones[bone_name]
+    pose_bone = armature.pose.bones[bone_name]
+    fingerprint.update(bone_name.encode())
+    fingerprint.update(pose_bone.rotation_mode.encode())
+    fingerprint.update(np.array(bone.matrix_local).tobytes())
+    if bone.parent:
+        fingerprint.update(repr((bone.parent.name, bone.use_inherit_rotation, bone.inherit_scale,
+                                 bone.use_local_location)).encode())
+    for constraint in pose_bone.constraints:
+        if constraint.mute:
+            continue
+        target = getattr(constraint, 'target', None)
+        if target is not None and target != armature:
+            return None
+        fingerprint.update(rna_settings(constraint).encode())
+    for channel in ('location', 'rotation_quaternion', 'rotation_euler', 'rotation_axis_angle', 'scale'):
+        for fcurve in sorted(index.get((bone_name, channel), ()), key=lambda fcurve: fcurve.array_index):
+            if fcurve.modifiers:
+                return None
+            fingerprint.update(repr((channel, fcurve.array_index, fcurve.mute, fcurve.extrapolation)).encode())
+            fingerprint.update(fcurve_keys(fcurve).tobytes())
+        # Components without a playing F-curve keep the value they were posed to
+        animated = {fcurve.array_index for fcurve in index.get((bone_name, channel), ()) if not fcurve.mute}
+        static = [value for array_index, value in enumerate(getattr(pose_bone, channel)) if array_index not in animated]
+        fingerprint.update(np.array(static, dtype=np.float64).tobytes())
+    return fingerprint.digest()
+
+# Function to start the digests of bone inputs for hash_bone_inputs, bones moved by IK chains are
+# also moved by bones below them and get no digest
+def bone_digests(ik_owners):
+    return dict.fromkeys(ik_owners)
+
+# Function to add the inputs of the animation of the given bones to a hash, digests of single bones are
+# kept in the given dictionary for further calls, returns False if the animation cannot be fingerprinted
+def hash_bone_inputs(fingerprint, armature, bone_names, index, digests):
+    for bone_name in sorted(bone_names):
+        if bone_name not in digests:
+            digests[bone_name] = bone_inputs_digest(armature, bone_name, index)
+        if digests[bone_name] is None:
+            return False
+        fingerprint.update(digests[bone_name])
+    return True
+
+# Function to get the fingerprint of the inputs of a bake of one bone: the rest pose and rotation mode of the
+# baked bone, the rest poses, constraints and F-curves of the bones it follows, the frame range, the sampling
+# settings and the offset of a locator, returns None where inputs outside of these may change the result
+def bake_fingerprint(armature, bone_name, source_name, st_frame, end_frame, props, index, digests, offset=None,
+                     channel_mask=None, ik_owners=None):
+    if not pose_cacheable(armature):
+        return None
+
+    fingerprint = hashlib.blake2b(digest_size=20)
+    sampling = (props.bake_sampling, props.bake_step)
+    if props.bake_sampling == 'ADAPTIVE':
+        sampling += (props.reduce_location_tolerance, props.reduce_rotation_tolerance)
+    fingerprint.update(repr((st_frame, end_frame, sampling, armature.pose.bones[bone_name].rotation_mode,
+                             sorted(channel_mask or ()))).encode())
+    if offset is not None:
+        fingerprint.update(np.asarray(offset, dtype=np.float64).tobytes())
+
+    # Only the rest pose of the baked bone matters unless it is its own source
+    bone = armature.data.bones[bone_name]
+    fingerprint.update(np.array(bone.matrix_local).tobytes())
+    if bone.parent:
+        fingerprint.update(repr((bone.parent.name, bone.use_inherit_rotation, bone.inherit_scale,
+                                 bone.use_local_location)).encode())
+    if not hash_bone_inputs(fingerprint, armature, dependency_bones(armature, [source_name], ik_owners), index,
+                            digests):
+        return None
+    return fingerprint.hexdigest()
+
+# Cache of pose space matrices of bones by frame, entries are keyed by a hash of the inputs of the animation
+# of a bone, so edits of the F-curves, constraints or static pose it depends on make its old samples unreachable,
+# least recently used entries are evicted beyond the memory limit
+class PoseSampleCache:
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.size = 0
+
+    # Function to get the cached matrices of a bone, returns a mask of the found frames and their matrices
+    def lookup(self, key, frames):
+        entry = self.entries.get(key)
+        if entry is None:
+            return np.zeros(len(frames), dtype=bool), None
+        self.entries.move_to_end(key)
+        cached_frames, matrices = entry
+        positions = np.minimum(np.searchsorted(cached_frames, frames), len(cached_frames) - 1)
+        found = cached_frames[positions] == frames
+        return found, matrices[positions[found]]
+
+    def store(self, key, frames, matrices, max_size):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[0].nbytes + entry[1].nbytes
+            keep = ~np.isin(entry[0], frames)
+            frames = np.concatenate([entry[0][keep], frames])
+            matrices = np.concatenate([entry[1][keep], matrices])
+        order = np.argsort(frames, kind='stable')
+        entry = (frames[order], matrices[order].astype(np.float32))
+        size = entry[0].nbytes + entry[1].nbytes
+        if size > max_size:
+            return
+        self.entries[key] = entry
+        self.size += size
+        while self.size > max_size:
+            _, (old_frames, old_matrices) = self.entries.popitem(last=False)
+            self.size -= old_frames.nbytes + old_matrices.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+pose_sample_cache = PoseSampleCache()
+
+# Function to get the keys of the sample cache for the given bones, bones whose animation cannot be
+# fingerprinted get no key
+def pose_sample_keys(scene, armature, bone_names, index):
+    if not scene.loca.sample_cache_size or not pose_cacheable(armature):
+        return {}
+    keys = {}
+    ik_owners = ik_chain_bones(armature)
+    digests = bone_digests(ik_owners)
+    for bone_name in bone_names:
+        fingerprint = hashlib.blake2b(digest_size=20)
+        if hash_bone_inputs(fingerprint, armature, dependency_bones(armature, [bone_name], ik_owners), index, digests):
+            keys[bone_name] = fingerprint.hexdigest()
+    return keys
+
+# Function to split bakes into those found in the bake cache and those to evaluate, bakes are
+# (bone name, source bone name, offset), returns ({bone name: (frames, channels)}, {bone name: fingerprint})
+def cached_bakes(scene, armature, bakes, st_frame, end_frame, index, channel_masks):
+    props = scene.loca
+    if not props.bake_cache_size:
+        return {}, {}
+    found = {}
+    fingerprints = {}
+    ik_owners = ik_chain_bones(armature)
+    digests = bone_digests(ik_owners)
+    for bone_name, source_name, offset in bakes:
+        fingerprint = bake_fingerprint(armature, bone_name, source_name, st_frame, end_frame, props, index, digests,
+                                       offset, channel_masks.get(bone_name), ik_owners)
+        if fingerprint is None:
+            continue
+        entry = bake_cache.get(fingerprint)
+        if entry is not None:
+            found[bone_name] = entry[:2]
+        else:
+            fingerprints[bone_name] = fingerprint
+    return found, fingerprints
+
+# Function to store evaluated bakes in the bake cache
+def cache_bakes(scene, baked, fingerprints):
+    max_size = scene.loca.bake_cache_size * 1024 * 1024
+    for bone_name, frames, channels in baked:
+        # Streamed bakes are too large for the cache
+        if bone_name in fingerprints and frames is not None:
+            bake_cache.put(fingerprints[bone_name], frames, channels, max_size)
+
+# Function to get the frames of all keys of the given bones
+def bone_key_frames(index, bone_names):
+    frames = [np.empty(0)]
+    for fcurve in bone_fcurves(index, bone_names):
+        co = np.empty(len(fcurve.keyframe_points) * 2, dtype=np.float32)
+        fcurve.keyframe_points.foreach_get('co', co)
+        frames.append(co[0::2])
+    return np.concatenate(frames)
+
+# Function to get the frames to bake according to the sampling policy, adaptive sampling starts from these
+def bake_frames(armature, bone_names, st_frame, end_frame, props, index):
+    if props.bake_sampling == 'STEP':
+        return np.union1d(np.arange(st_frame, end_frame + 1, max(props.bake_step, 1)), [end_frame])
+    if props.bake_sampling == 'ALL':
+        return np.arange(st_frame, end_frame + 1)
+
+    frames = [st_frame, end_frame]
+    if props.bake_sampling == 'ADAPTIVE':
+        frames = np.union1d(frames, np.arange(st_frame, end_frame + 1, ADAPTIVE_GRID))
+    key_frames = np.round(bone_key_frames(index, dependency_bones(armature, bone_names))).astype(int)
+    key_frames = key_frames[(key_frames >= st_frame) & (key_frames <= end_frame)]
+    return np.union1d(frames, key_frames)
+
+# Function to split the frames to bake into windows whose samples and keys stay within the bake memory limit,
+# neighbouring windows share their boundary frame, adaptive sampling may fill every frame of a window
+def bake_windows(props, frames, sample_count, key_count):
+    limit = props.bake_memory_limit * 1024 * 1024
+    frame_bytes = sample_count * BAKE_SAMPLE_BYTES + key_count * BAKE_KEY_BYTES
+    span = max(limit // frame_bytes, 1) if limit and frame_bytes else 0
+    if not span or frames[-1] - frames[0] < span:
+        return [frames]
+
+    windows = []
+    start = 0
+    while start < len(frames) - 1:
+        end = max(int(np.searchsorted(frames, frames[start] + span, side='right')) - 1, start + 1)
+        windows.append(frames[start:end + 1])
+        start = end
+    return windows
+
+# Function to check whether pose matrices in the middle of an interval deviate from the interpolation
+# of the matrices at its ends by more than the tolerances
+def deviates_from_interpolation(start, end, middle, factor, props):
+    location = start[:, :3, 3] * (1 - factor) + end[:, :3, 3] * factor
+    if (np.linalg.norm(middle[:, :3, 3] - location, axis=1) > props.reduce_location_tolerance).any():
+        return True
+
+    quats = [rotations_to_quaternions(m[:, :3, :3] / np.linalg.norm(m[:, :3, :3], axis=1)[:, None, :])
+             for m in (start, end, middle)]
+    quats[1] *= np.sign(np.einsum('ij,ij->i', quats[0], quats[1]) + 1e-12)[:, None]
+    rotation = quats[0] * (1 - factor) + quats[1] * factor
+    rotation /= np.linalg.norm(rotation, axis=1)[:, None]
+    dots = np.abs(np.einsum('ij,ij->i', rotation, quats[2]))
+    return (2 * np.arccos(np.clip(dots, 0.0, 1.0)) > props.reduce_rotation_tolerance).any()
+
+# Function to check whether a constraint is one of those loca adds with its default settings
+def loca_constraint_supported(armature, constraint):
+    if constraint.type not in constraint_channels or constraint.target != armature or constraint.influence != 1.0 \
+            or getattr(constraint, 'head_tail', 0.0) != 0.0:
+        return False
+    if constraint.type == 'DAMPED_TRACK':
+        return True
+    if constraint.owner_space != 'WORLD' or constraint.target_space != 'WORLD':
+        return False
+    if constraint.type == 'COPY_TRANSFORMS':
+        return constraint.mix_mode == 'REPLACE' and not constraint.remove_target_shear
+    axes_used = constraint.use_x and constraint.use_y and constraint.use_z
+    inverted = constraint.invert_x or constraint.invert_y or constraint.invert_z
+    if constraint.type == 'COPY_LOCATION':
+        return axes_used and not inverted and not constraint.use_offset
+    return axes_used and not inverted and constraint.mix_mode == 'REPLACE'
+
+# Function to check whether the poses of bones follow from F-curves alone: their parent chains and constraint
+# targets have default inheritance, no constraints but those loca adds and are not moved by IK chains,
+# ik_owners is the result of ik_chain_bones if already known
+def analytic_pose_supported(armature, bone_names, ik_owners=None):
+    if not pose_cacheable(armature):
+        return False
+    if ik_owners is None:
+        ik_owners = ik_chain_bones(armature)
+    bones = armature.data.bones
+    checked = set()
+    stack = list(bone_names)
+    while stack:
+        bone_name = stack.pop()
+        if bone_name in checked:
+            continue
+        checked.add(bone_name)
+        if bone_name in ik_owners:
+            return False
+        bone = bones[bone_name]
+        if not bone.use_local_location:
+            return False
+        if bone.parent:
+            if not (bone.use_inherit_rotation and bone.inherit_scale == 'FULL'):
+                return False
+            stack.append(bone.parent.name)
+        for constraint in armature.pose.bones[bone_name].constraints:
+            if constraint.mute:
+                continue
+            if not loca_constraint_supported(armature, constraint) or constraint.subtarget not in bones:
+                return False
+            stack.append(constraint.subtarget)
+    return True
+
+# Function to evaluate the F-curves of one channel of a pose bone for a list of frames,
+# components without F-curves keep their current value
+def channel_values(index, pose_bone, channel, frames):
+    values = np.tile(np.array(getattr(pose_bone, channel), dtype=float), (len(frames), 1))
+    for fcurve in index.get((pose_bone.name, channel), ()):
+        if not fcurve.mute and fcurve.array_index < values.shape[1]:
+            values[:, fcurve.array_index] = [fcurve.evaluate(frame) for frame in frames]
+    return values
+
+# Function to get rotation matrices about the X, Y or Z axis
+def axis_rotations(axis, angles):
+    cos = np.cos(angles)
+    sin = np.sin(angles)
+    i, j = [(1, 2), (2, 0), (0, 1)][axis]
+    rotations = np.zeros((len(angles), 3, 3))
+    rotations[:, axis, axis] = 1.0
+    rotations[:, i, i] = cos
+    rotations[:, j, j] = cos
+    rotations[:, i, j] = -sin
+    rotations[:, j, i] = sin
+    return rotations
+
+# Function to get rotation matrices from unit axes and angles
+def axis_angle_rotations(axes, angles):
+    cos = np.cos(angles)[:, None, None]
+    sin = np.sin(angles)[:, None, None]
+    cross = np.zeros((len(axes), 3, 3))
+    cross[:, 0, 1], cross[:, 0, 2], cross[:, 1, 2] = -axes[:, 2], axes[:, 1], -axes[:, 0]
+    cross = cross - cross.transpose(0, 2, 1)
+    return cos * np.eye(3) + sin * cross + (1 - cos) * axes[:, :, None] * axes[:, None, :]
+
+# Function to compute the basis matrices of a pose bone from its F-curves for a list of frames
+def basis_matrices(index, pose_bone, frames):
+    rotation_mode = pose_bone.rotation_mode
+    if rotation_mode == 'QUATERNION':
+        quaternions = channel_values(index, pose_bone, 'rotation_quaternion', frames)
+        w, x, y, z = (quaternions / np.linalg.norm(quaternions, axis=1, keepdims=True)).T
+        rotations = np.stack([
+            np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)], axis=1),
+            np.stack([2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)], axis=1),
+            np.stack([2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)], axis=1)], axis=1)
+    elif rotation_mode == 'AXIS_ANGLE':
+        axis_angles = channel_values(index, pose_bone, 'rotation_axis_angle', frames)
+        lengths = np.linalg.norm(axis_angles[:, 1:], axis=1, keepdims=True)
+        axes = np.divide(axis_angles[:, 1:], lengths, out=np.zeros_like(axis_angles[:, 1:]), where=lengths > 0)
+        rotations = axis_angle_rotations(axes, np.where(lengths[:, 0] > 0, axis_angles[:, 0], 0.0))
+    else:
+        # The first axis of the rotation order is applied first
+        eulers = channel_values(index, pose_bone, 'rotation_euler', frames)
+        rotations = np.broadcast_to(np.eye(3), (len(frames), 3, 3))
+        for axis in ['XYZ'.index(axis_name) for axis_name in rotation_mode]:
+            rotations = axis_rotations(axis, eulers[:, axis]) @ rotations
+
+    matrices = np.zeros((len(frames), 4, 4))
+    matrices[:, :3, :3] = rotations * channel_values(index, pose_bone, 'scale', frames)[:, None, :]
+    matrices[:, :3, 3] = channel_values(index, pose_bone, 'location', frames)
+    matrices[:, 3, 3] = 1.0
+    return matrices
+
+# Function to apply a damped track to pose matrices, the track axis is rotated by the shortest arc
+# towards the target positions around the head of the bone
+def damped_track_matrices(matrices, targets, track_axis):
+    axis = 'XYZ'.index(track_axis[-1])
+    current = matrices[:, :3, axis] * (-1 if 'NEGATIVE' in track_axis else 1)
+    current = current / np.linalg.norm(current, axis=1, keepdims=True)
+    wanted = targets - matrices[:, :3, 3]
+    lengths = np.linalg.norm(wanted, axis=1, keepdims=True)
+    wanted = np.divide(wanted, lengths, out=current.copy(), where=lengths > 1e-6)
+
+    axes = np.cross(current, wanted)
+    sines = np.linalg.norm(axes, axis=1)
+    angles = np.arccos(np.clip(np.einsum('ij,ij->i', current, wanted), -1.0, 1.0))
+    # Opposite vectors turn around any axis perpendicular to the track axis
+    perpendicular = np.cross(current, np.where(np.abs(current[:, :1]) < 0.9, [[1.0, 0.0, 0.0]], [[0.0, 1.0, 0.0]]))
+    axes = np.where((sines > 1e-6)[:, None], axes, perpendicular)
+    axes /= np.linalg.norm(axes, axis=1, keepdims=True)
+
+    tracked = matrices.copy()
+    tracked[:, :3, :3] = axis_angle_rotations(axes, angles) @ matrices[:, :3, :3]
+    return tracked
+
+# Function to compute pose space matrices of bones for a list of frames from F-curves without evaluating
+# the depsgraph, for bones accepted by analytic_pose_supported, returns (frames, bones, 4, 4) matrices
+def analytic_pose_matrices(armature, bone_names, frames, index):
+    bones = armature.data.bones
+    pose_bones = armature.pose.bones
+    poses = {}
+
+    def pose(bone_name):
+        if bone_name in poses:
+            return poses[bone_name]
+        bone = bones[bone_name]
+        rest = np.array(bone.matrix_local)
+        matrices = basis_matrices(index, pose_bones[bone_name], frames)
+        if bone.use_connect:
+            # Connected bones ignore their location
+            matrices[:, :3, 3] = 0.0
+        if bone.parent:
+            matrices = pose(bone.parent.name) @ (np.linalg.inv(np.array(bone.parent.matrix_local)) @ rest) @ matrices
+        else:
+            matrices = rest @ matrices
+        for constraint in pose_bones[bone_name].constraints:
+            if constraint.mute:
+                continue
+            if constraint.type == 'COPY_TRANSFORMS':
+                matrices = pose(constraint.subtarget).copy()
+            elif constraint.type == 'COPY_LOCATION':
+                matrices = matrices.copy()
+                matrices[:, :3, 3] = pose(constraint.subtarget)[:, :3, 3]
+            elif constraint.type == 'COPY_ROTATION':
+                # The rotation of the target replaces the rotation of the bone, its scale is kept
+                target = pose(constraint.subtarget)[:, :3, :3]
+                matrices = matrices.copy()
+                matrices[:, :3, :3] = (target / np.linalg.norm(target, axis=1, keepdims=True)
+                                       * np.linalg.norm(matrices[:, :3, :3], axis=1, keepdims=True))
+            else:
+                matrices = damped_track_matrices(matrices, pose(constraint.subtarget)[:, :3, 3],
+                                                 constraint.track_axis)
+        poses[bone_name] = matrices
+        return matrices
+
+    return np.stack([pose(bone_name) for bone_name in bone_names], axis=1)
+
+# Generator to compute pose space matrices from F-curves, yields once as all frames are computed together
+def analytic_pose_matrices_steps(armature, bone_names, frames, index):
+    with profile_phase('analytic poses'):
+        samples = analytic_pose_matrices(armature, bone_names, np.asarray(frames), index)
+    yield
+    return samples
+
+# Generator to choose the frames to bake and sample pose matrices of the given bones on them,
+# adaptive sampling bisects intervals level by level where the motion deviates from interpolation,
+# analytic sampling computes the poses from F-curves instead of evaluating the depsgraph,
+# frames given by the caller replace those of the sampling policy
+def sample_bake_frames_steps(scene, armature, bone_names, st_frame, end_frame, index, analytic=False, frames=None):
+    def sample_steps(frames):
+        if analytic:
+            return analytic_pose_matrices_steps(armature, bone_names, frames, index)
+        return sample_pose_matrices_steps(scene, armature, bone_names, frames, index)
+
+    props = scene.loca
+    if frames is None:
+        frames = bake_frames(armature, bone_names, st_frame, end_frame, props, index)
+    samples = yield from sample_steps(frames)
+    if props.bake_sampling != 'ADAPTIVE':
+        return frames, samples
+
+    sampled = dict(zip(frames.tolist(), samples))
+    intervals = [(a, b) for a, b in zip(frames[:-1].tolist(), frames[1:].tolist()) if b - a > 1]
+    while intervals:
+        middles = [(a + b) // 2 for a, b in intervals]
+        middle_samples = yield from sample_steps(middles)
+        next_intervals = []
+        for (a, b), middle, matrices in zip(intervals, middles, middle_samples):
+            if deviates_from_interpolation(sampled[a], sampled[b], matrices, (middle - a) / (b - a), props):
+                sampled[middle] = matrices
+                next_intervals += [(c, d) for c, d in ((a, middle), (middle, b)) if d - c > 1]
+        intervals = next_intervals
+
+    frames = np.array(sorted(sampled))
+    return frames, np.stack([sampled[frame] for frame in frames])
+
+# Generator to sample bones over a range and convert the samples to keys of key_count bones, convert takes
+# frames, samples and a dict of continuity state per bone and returns a list of (bone name, frames, channels),
+# ranges exceeding the bake memory limit are sampled window by window and staged as keys after every window
+def bake_keys_steps(scene, armature, sample_names, key_count, st_frame, end_frame, index, analytic, convert):
+    props = scene.loca
+    windows = bake_windows(props, bake_frames(armature, sample_names, st_frame, end_frame, props, index),
+                           len(sample_names), key_count)
+    if len(windows) == 1:
+        frames, samples = yield from sample_bake_frames_steps(scene, armature, sample_names, st_frame, end_frame,
+                                                              index, analytic, windows[0])
+        with profile_phase('convert matrices'):
+            return convert(frames, samples, None)
+
+    staged = StagedBake(key_reduction(props))
+    continuity = {}
+    for i, window in enumerate(windows):
+        frames, samples = yield from sample_bake_frames_steps(scene, armature, sample_names, st_frame, end_frame,
+                                                              index, analytic, window)
+        if i:
+            # The boundary frame was baked with the previous window
+            frames, samples = frames[1:], samples[1:]
+        with profile_phase('convert matrices'):
+            baked = convert(frames, samples, continuity)
+        with profile_phase('stage keys'):
+            staged.append(baked, final=i == len(windows) - 1)
+    return [(bone_name, None, staged) for bone_name in staged.bone_names]
+
+# Generator to compute the keys of several pose bones from their visual transforms in a single sweep,
+# returns a list of (bone name, frames, channels) ready for write_baked_keys
+def pose_bone_keys_steps(scene, armature, bone_names, st_frame, end_frame, index, channel_masks=None):
+    channel_masks = channel_masks or {}
+    found, fingerprints = cached_bakes(scene, armature, [(name, name, None) for name in bone_names],
+                                       st_frame, end_frame, index, channel_masks)
+    baked = [(bone_name, *found[bone_name]) for bone_name in bone_names if bone_name in found]
+    bone_names = [bone_name for bone_name in bone_names if bone_name not in found]
+    if not bone_names:
+        return baked
+
+    # Bones following locators through plain chains are computed from F-curves, the others are evaluated
+    ik_owners = ik_chain_bones(armature)
+    analytic_names = [bone_name for bone_name in bone_names
+                      if analytic_pose_supported(armature, [bone_name], ik_owners)]
+    evaluated_names = [bone_name for bone_name in bone_names if bone_name not in analytic_names]
+
+    bones = armature.data.bones
+    evaluated = []
+    for group, analytic in ((analytic_names, True), (evaluated_names, False)):
+        if not group:
+            continue
+        sample_names = list(dict.fromkeys(
+            group + [bones[name].parent.name for name in group if bones[name].parent]))
+        sample_index = {name: i for i, name in enumerate(sample_names)}
+
+        def convert(frames, samples, continuity):
+            converted = []
+            for bone_name in group:
+                parent = bones[bone_name].parent
+                parent_matrices = samples[:, sample_index[parent.name]] if parent else None
+                local = pose_to_local(armature, bone_name, samples[:, sample_index[bone_name]], parent_matrices)
+                converted.append((bone_name, frames, matrices_to_channels(
+                    armature.pose.bones[bone_name], local, channel_masks.get(bone_name),
+                    None if continuity is None else continuity.setdefault(bone_name, {}))))
+            return converted
+
+        evaluated += yield from bake_keys_steps(scene, armature, sample_names, len(group), st_frame, end_frame,
+                                                index, analytic, convert)
+    cache_bakes(scene, evaluated, fingerprints)
+    return baked + evaluated
+
+# Generator to compute the keys of locators from the world matrices of their source bones without any
+# constraints, every locator follows its source bone with an optional constant offset,
+# only the channels of the registry record of a locator are baked
+def locator_keys_steps(scene, armature, locators, st_frame, end_frame, index):
+    registry = locator_registry(armature)
+    channel_masks = {name: set(registry[name].channels) for name, _, _ in locators if name in registry}
+    found, fingerprints = cached_bakes(scene, armature, locators, st_frame, end_frame, index, channel_masks)
+    baked = [(locator_name, *found[locator_name]) for locator_name, _, _ in locators if locator_name in found]
+    locators = [locator for locator in locators if locator[0] not in found]
+    if not locators:
+        return baked
+
+    source_names = list(dict.fromkeys(source_name for _, source_name, _ in locators))
+    analytic = analytic_pose_supported(armature, source_names)
+
+    def convert(frames, samples, continuity):
+        converted = []
+        for locator_name, source_name, offset in locators:
+            pose_matrices = samples[:, source_names.index(source_name)]
+            if offset is not None:
+                pose_matrices = pose_matrices @ offset
+            local = pose_to_local(armature, locator_name, pose_matrices)
+            converted.append((locator_name, frames, matrices_to_channels(
+                armature.pose.bones[locator_name], local, channel_masks.get(locator_name),
+                None if continuity is None else continuity.setdefault(locator_name, {}))))
+        return converted
+
+    evaluated = yield from bake_keys_steps(scene, armature, source_names, len(locators), st_frame, end_frame,
+                                           index, analytic, convert)
+    cache_bakes(scene, evaluated, fingerprints)
+    return baked + evaluated
+
+# Function to write computed keys of several bones, keys of streamed bakes are moved from their staging action
+def write_baked_keys(scene, armature, index, baked):
+    reduction = key_reduction(scene.loca)
+    with profile_phase('write keys'):
+        for bone_name, frames, channels in baked:
+            if frames is None:
+                channels.write(armature, index, bone_name)
+            else:
+                write_bone_keys(armature, index, bone_name, frames, channels, reduction)
+
+# Chunked bake running from bpy.app.timers, evaluates a bounded number of frames per tick
+class BakeTask:
+    def __init__(self, steps, total, frames_per_tick):
+        self.steps = steps
+        self.total = max(total, 1)
+        self.frames_per_tick = frames_per_tick
+        self.done = 0
+        self.result = None
+        self.error = None
+        self.finished = False
+        self.cancelled = False
+
+    def tick(self):
+        if self.finished or self.cancelled:
+            return None
+        try:
+            with profile_phase('bake frames'):
+                for _ in range(self.frames_per_tick):
+                    finished = next(self.steps)
+                    if finished is not None:
+                        # Waiting for background workers ends the tick so the interface is not blocked
+                        self.done += finished
+                        return BAKE_WAIT_INTERVAL
+                    self.done += 1
+        except StopIteration as stop:
+            self.result = stop.value
+            self.finished = True
+            return None
+        except Exception as error:
+            self.error = error
+            self.finished = True
+            return None
+        return 0.0
+
+    def cancel(self):
+        self.cancelled = True
+        self.steps.close()
+
+# Events passed to the interface during a modal bake, others are blocked as they could undo or edit the rig
+BAKE_PASS_THROUGH_EVENTS = {
+    'MOUSEMOVE', 'INBETWEEN_MOUSEMOVE', 'WHEELUPMOUSE', 'WHEELDOWNMOUSE', 'MIDDLEMOUSE', 'TRACKPADPAN',
+    'TRACKPADZOOM', 'MOUSEROTATE', 'NDOF_MOTION', 'WINDOW_DEACTIVATE', 'TIMER', 'TIMER_REPORT',
+}
+
+# Base class for operators which bake in chunks while the UI stays responsive, Esc cancels the bake,
+# subclasses implement bake_prepare, bake_finish and bake_rollback, execute runs the same steps blocking,
+# finish and rollback find the armature with bake_armature as the active object may have changed meanwhile
+class LocaModalBake:
+    # Function to prepare the bake, returns (steps, number of frames) or None if nothing has to be baked
+    def bake_prepare(self, context):
+        return None
+
+    # Function to apply the result of the bake
+    def bake_finish(self, context, result):
+        pass
+
+    # Function to undo the preparation of a cancelled bake
+    def bake_rollback(self, context):
+        pass
+
+    # Function to get the armature the bake was prepared for, None if it was deleted
+    def bake_armature(self):
+        return bpy.data.objects.get(self.armature_name)
+
+    @profiled
+    def execute(self, context):
+        self.armature_name = context.active_object.name
+        with profile_phase('prepare'):
+            prepared = self.bake_prepare(context)
+        if prepared is None:
+            return {'FINISHED'}
+        with profile_phase('bake frames'):
+            result = run_bake_steps(prepared[0])
+        with profile_phase('finish'):
+            self.bake_finish(context, result)
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        # Without a window there is no interface to keep responsive
+        if context.window is None:
+            return self.execute(context)
+
+        # The profile of a modal bake lasts until the bake ends, it also ends when preparing fails
+        self.profiling = profile_begin(context, self.bl_idname)
+        running = False
+        try:
+            self.armature_name = context.active_object.name
+            with profile_phase('prepare'):
+                prepared = self.bake_prepare(context)
+            if prepared is None:
+                return {'FINISHED'}
+            self.armature_mode = self.bake_armature().mode
+
+            self._task = BakeTask(*prepared, context.scene.loca.frames_per_tick)
+            wm = context.window_manager
+            self._timer = wm.event_timer_add(0.1, window=context.window)
+            wm.modal_handler_add(self)
+            wm.progress_begin(0, 100)
+            bpy.app.timers.register(self._task.tick)
+            running = True
+            return {'RUNNING_MODAL'}
+        finally:
+            if not running:
+                self.bake_profile_end(context)
+
+    def modal(self, context, event):
+        task = self._task
+        armature = self.bake_armature()
+        if event.type == 'ESC' or armature is None or armature.mode != self.armature_mode:
+            task.cancel()
+            self.bake_end(context)
+            try:
+                if armature is not None:
+                    self.bake_rollback(context)
+            finally:
+                self.bake_profile_end(context)
+            self.report({'WARNING'}, "Baking cancelled" if event.type == 'ESC'
+                        else "Baking cancelled, the armature was removed or left its mode")
+            return {'CANCELLED'}
+
+        if task.finished:
+            self.bake_end(context)
+            try:
+                if task.error is not None:
+                    self.bake_rollback(context)
+                    self.report({'ERROR'}, f"Baking failed: {task.error}")
+                    return {'CANCELLED'}
+                with profile_phase('finish'):
+                    self.bake_finish(context, task.result)
+            finally:
+                self.bake_profile_end(context)
+            return {'FINISHED'}
+
+        if event.type == 'TIMER':
+            progress = min(task.done / task.total, 1.0)
+            context.window_manager.progress_update(int(progress * 100))
+            context.workspace.status_text_set(
+                f"Loca: baking {task.done}/{task.total} frames ({progress:.0%}), Esc to cancel")
+        return {'PASS_THROUGH'} if event.type in BAKE_PASS_THROUGH_EVENTS else {'RUNNING_MODAL'}
+
+    # Function to end the profile of a modal bake if the bake started it
+    def bake_profile_end(self, context):
+        if self.profiling:
+            self.profiling = False
+            profile_end(self, context)
+
+    # Function to remove the timer and progress display
+    def bake_end(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+
+# Property group to store a constraint name
+class locaConstraint(PropertyGroup):
+    pass
+
+# Property group to store a span of frames
+class locaFrameSpan(PropertyGroup):
+    frame_start: IntProperty(
+        name="Start",
+        description="First frame of the span",
+    )
+
+    frame_end: IntProperty(
+        name="End",
+        description="Last frame of the span",
+    )
+
+# Property group to store one record of the locator registry
+class locaLocator(PropertyGroup):
+    bone: StringProperty(
+        name="Source Bone",
+        description="Bone the locator was created for",
+    )
+
+    mode: EnumProperty(
+        name="Mode",
+        items=locator_modes,
+        description="Locator mode",
+        default="LOCATION",
+    )
+
+    frame_start: IntProperty(
+        name="Start",
+        description="Baking start frame",
+    )
+
+    frame_end: IntProperty(
+        name="End",
+        description="Baking end frame",
+    )
+
+    constraints: CollectionProperty(
+        type=locaConstraint,
+        description="Constraints added to the source bone",
+    )
 
-# Function to hide scale F-curves
-def hide_scale_fcurves(armature_name, bone_name='_LOCA'):
-    if bpy.data.objects[armature_name].animation_data.action:
-        for fcurve in bpy.data.objects[armature_name].animation_data.action.fcurves:
-            if '_LOCA' in fcurve.data_path or bone_name in fcurve.data_path:
-                if 'scale' in fcurve.data_path:
-                    fcurve.hide = True
+    pending: BoolProperty(
+        name="Pending",
+        description="Rotation target locator waits for placement",
+        default=False,
+    )
+
+    channels: EnumProperty(
+        name="Channels",
+        items=channel_items,
+        description="Channels baked for the locator",
+        options={'ENUM_FLAG'},
+        default={'LOCATION', 'ROTATION', 'SCALE'},
+    )
+
+    offset: FloatVectorProperty(
+        name="Offset",
+        description="Matrix of the locator relative to its source bone, rows one after another",
+        size=16,
+        default=(1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1),
+    )
+
+    dirty: CollectionProperty(
+        type=locaFrameSpan,
+        description="Frame spans where the animation of the source bone changed since the bake",
+    )
 
 # Property group to store addon properties
 class locaProps(PropertyGroup):
@@ -70,6 +1801,13 @@ class locaProps(PropertyGroup):
         default=False,
     )
 
+    locator_channels: EnumProperty(
+        name="Channels",
+        items=locator_channel_modes,
+        description="Channels a location target drives",
+        default="LOCATION_ROTATION",
+    )
+
     baking_frame_range: BoolProperty(
         name="Baking in Frame Range",
         description="Baking in frame range",
@@ -88,6 +1826,102 @@ class locaProps(PropertyGroup):
         default = 1,
     )
 
+    frames_per_tick: IntProperty(
+        name="Frames per Update",
+        description="Number of frames baked between updates of the interface",
+        default=20,
+        min=1,
+    )
+
+    bake_workers: IntProperty(
+        name="Workers",
+        description="Number of background Blender processes sharing long bakes, 1 bakes in this session",
+        default=1,
+        min=1,
+        max=64,
+    )
+
+    bake_sampling: EnumProperty(
+        name="Sampling",
+        items=sampling_modes,
+        description="Frames to bake",
+        default="ALL",
+    )
+
+    bake_step: IntProperty(
+        name="Step",
+        description="Bake every Nth frame",
+        default=2,
+        min=1,
+    )
+
+    reduce_keys: BoolProperty(
+        name="Reduce Keys",
+        description="Replace baked keys on every frame by fewer Bezier keys within tolerance",
+        default=False,
+    )
+
+    reduce_location_tolerance: FloatProperty(
+        name="Location",
+        description="Maximum distance of reduced location and scale curves and of adaptive sampling",
+        default=0.001,
+        min=0.0,
+        precision=4,
+        unit='LENGTH',
+    )
+
+    reduce_rotation_tolerance: FloatProperty(
+        name="Rotation",
+        description="Maximum angle of reduced rotation curves and of adaptive sampling",
+        default=0.001745,
+        min=0.0,
+        precision=3,
+        subtype='ANGLE',
+    )
+
+    isolated_evaluation: BoolProperty(
+        name="Evaluate Rig Only",
+        description="Evaluate only the armature and the objects it depends on while baking, instead of the "
+                    "whole scene on every frame",
+        default=True,
+    )
+
+    bake_memory_limit: IntProperty(
+        name="Bake Memory (MB)",
+        description="Memory for samples and keys of one bake, longer ranges are baked in windows of frames "
+                    "within it, 0 bakes any range at once",
+        default=1024,
+        min=0,
+    )
+
+    sample_cache_size: IntProperty(
+        name="Sample Cache (MB)",
+        description="Memory for evaluated bone matrices which are reused by later bakes of the same frames, "
+                    "0 disables it",
+        default=256,
+        min=0,
+    )
+
+    bake_cache_size: IntProperty(
+        name="Bake Cache (MB)",
+        description="Memory for keys of earlier bakes which are reused when the same bake repeats, 0 disables it",
+        default=256,
+        min=0,
+    )
+
+    profile: BoolProperty(
+        name="Profile",
+        description="Report the time of every phase of the operators and write a trace for chrome://tracing",
+        default=False,
+    )
+
+    profile_path: StringProperty(
+        name="Trace",
+        description="File of the trace, relative to the blend file or the temporary directory if it is unsaved",
+        default="//loca_trace.json",
+        subtype='FILE_PATH',
+    )
+
 # Operator to get the preview range
 class Loca_OT_get_preview_range(Operator):
     bl_idname = "scene.get_preview_range"
@@ -103,7 +1937,7 @@ class Loca_OT_get_preview_range(Operator):
         return {'FINISHED'}   
 
 # Operator to create locators
-class Loca_OT_create_locators(Operator):
+class Loca_OT_create_locators(LocaModalBake, Operator):
     """Create locators"""
 
     bl_label = 'create_locators'
@@ -117,144 +1951,176 @@ class Loca_OT_create_locators(Operator):
     )
 
     # Function to create a widget for locators
-    def create_widget(self, current_armature):
+    def create_widget(self, context):
         widget_obj_name = 'wgt_loca'
         if widget_obj_name in bpy.data.objects:
             return
-        bpy.ops.object.mode_set(mode='OBJECT')
-        bpy.ops.object.empty_add()
-        bpy.context.object.name = widget_obj_name
-        bpy.context.object.hide_viewport = True
-        bpy.context.view_layer.objects.active = current_armature
-        bpy.ops.object.mode_set(mode='POSE')
-
-    # Function to create a locator bone
-    def create_locator(self, context, bone_P, props):
-        armature = context.active_object
-        st_frame = props.bake_start_fr
-        end_frame = props.bake_end_fr
+        widget = bpy.data.objects.new(widget_obj_name, None)
+        widget.hide_viewport = True
+        context.scene.collection.objects.link(widget)
 
-        # Set start and end frames to scene frame range if baking_frame_range is False
-        if not props.baking_frame_range:
-            st_frame = context.scene.frame_start
-            end_frame = context.scene.frame_end
-
-        # Generate unique locator name
-        locator_base_name = f'{bone_P.name}_LOCA_RT' if self.rt_mode else f'{bone_P.name}_LOCA'
+    # Function to generate unique locator name
+    def locator_name(self, armature, bone_name, taken):
+        locator_base_name = f'{bone_name}_LOCA_RT' if self.rt_mode else f'{bone_name}_LOCA'
         locator_name = locator_base_name
         count = 1
-        while locator_name in armature.pose.bones:
+        while locator_name in armature.pose.bones or locator_name in taken:
             locator_name = f"{locator_base_name}.{count:03d}"
             count += 1
+        return locator_name
 
-        # # set name for locator
-        # if self.rt_mode:
-        #     locator_name = f'{bone_P.name}_LOCA_RT'
-        # else:
-        #     locator_name = f'{bone_P.name}_LOCA'
-
-        # create new bone for locator at the place of selected bone
-        bpy.ops.object.mode_set(mode='EDIT')
-        source_E = armature.data.edit_bones[bone_P.name]
-        locator_E = armature.data.edit_bones.new(locator_name)
-        locator_E.head = source_E.head
-        locator_E.tail = source_E.tail
-        locator_E.matrix = source_E.matrix
-
-        bpy.ops.object.mode_set(mode='POSE')
-        locator_P = context.object.pose.bones[locator_name]
-        # set widget for locator
-        locator_P.custom_shape = bpy.data.objects["wgt_loca"]
+    # Function to create locator bones for all selected bones in one edit mode session
+    def create_locator_bones(self, context, bone_names):
+        armature = context.active_object
+        locators = []
+        for bone_name in bone_names:
+            locators.append((bone_name, self.locator_name(armature, bone_name, {loc for _, loc in locators})))
+
+        # create new bones for locators at the place of selected bones
+        set_armature_mode(armature, 'EDIT')
+        edit_bones = armature.data.edit_bones
+        for bone_name, locator_name in locators:
+            source_E = edit_bones[bone_name]
+            locator_E = edit_bones.new(locator_name)
+            locator_E.head = source_E.head
+            locator_E.tail = source_E.tail
+            locator_E.matrix = source_E.matrix
+        set_armature_mode(armature, 'POSE')
+
+        return locators
+
+    # Function to set up created locators in POSEMODE, returns locators which have to be baked
+    def setup_locators(self, context, locators, props):
+        armature = context.active_object
+        widget = bpy.data.objects["wgt_loca"]
+
+        for bone_name, locator_name in locators:
+            # set widget for locator
+            armature.pose.bones[locator_name].custom_shape = widget
+
+        if not self.rt_mode and not props.without_baking:
+            # Locators are baked later together in one sweep
+            return locators
+
+        # Locators take the current visual transforms of their source bones, all read from one evaluated pose
+        bone_index, matrices = read_pose_matrices(armature)
+        set_root_pose_matrices(armature, [locator_name for _, locator_name in locators],
+                               matrices[[bone_index[bone_name] for bone_name, _ in locators]])
+        deselect_bones(armature)
+        for bone_name, locator_name in locators:
+            armature.pose.bones[locator_name].bone.select = True
         # make locator active in POSEMODE
-        context.object.data.bones.active = locator_P.bone
-
-        # for locator add constraint from selected bone
-        copy_transforms = locator_P.constraints.new('COPY_TRANSFORMS')
-        copy_transforms.target = armature
-        copy_transforms.subtarget = bone_P.name
+        armature.data.bones.active = armature.data.bones[locators[-1][1]]
 
         if self.rt_mode:
-            print('locator in RT mode')
-            locators_RT_name_list.append(locator_name)
-            bpy.ops.pose.visual_transform_apply()
-            constraint = locator_P.constraints[0]
-            locator_P.constraints.remove(constraint)
             props.locator_positioning = True
-            bpy.ops.pose.select_all(action='DESELECT')
-            locator_P.bone.select = True
             show_message_box(
                 'Choose position for locator and press button "Apply locator placement"', 'LOCATOR POSITIONING')
-
-        else:
-            if props.without_baking:
-                bpy.ops.pose.visual_transform_apply()
-                constraint = locator_P.constraints[0]
-                locator_P.constraints.remove(constraint)
-
-                # child_of = locator_P.constraints.new('CHILD_OF')
-                # child_of.target = armature
-                # child_of.subtarget = bone_P.name
-            else:
-                bpy.ops.pose.select_all(action='DESELECT')
-
-                # Select the specific bone
-                locator_P.bone.select = True
-                bpy.ops.anim.keyframe_insert_menu(type='Location')
-
-                bpy.ops.nla.bake(frame_start=st_frame, frame_end=end_frame, only_selected=True,
-                                 visual_keying=True, clear_constraints=True, use_current_action=True, bake_types={'POSE'})
-
-                if locator_P.constraints:
-                    print('Not baked')
-                    locator_P.constraints.remove(locator_P.constraints[0])
-                else:
-                    hide_scale_fcurves(armature.name)
-                    copy_transforms = bone_P.constraints.new('COPY_TRANSFORMS')
-                    copy_transforms.name = 'Copy locator transforms__Loca'
-                    copy_transforms.target = armature
-                    copy_transforms.subtarget = locator_name
-                    print(f'{bone_P.name} received location from locator')
-
-                    if bpy.context.mode != "POSE":
-                        bpy.ops.object.mode_set(mode='POSE')
-
-                    # Deselect all bones
-                    bpy.ops.pose.select_all(action='DESELECT')
-
-                    # Select the specific bone
-                    armature.data.bones.active = armature.data.bones[locator_name]
-                    armature.pose.bones[locator_name].bone.select = True
+        return []
+
+    # Function to hand the baked channels of the source bone over to its locator
+    def connect_locator(self, armature, bone_name, locator_name):
+        bone_P = armature.pose.bones[bone_name]
+        locator = armature.data.loca_locators[locator_name]
+        for channel, constraint_type in (('LOCATION', 'COPY_LOCATION'), ('ROTATION', 'COPY_ROTATION')):
+            if channel not in locator.channels:
+                continue
+            constraint = bone_P.constraints.new(constraint_type)
+            constraint.name = f'Copy locator {channel.lower()}__Loca'
+            constraint.target = armature
+            constraint.subtarget = locator_name
+            locator.constraints.add().name = constraint.name
 
     @classmethod
     def poll(cls, context):
-        return context.selected_pose_bones is not None
+        return armature_in_pose_mode(context)
 
-    def execute(self, context):
+    def bake_prepare(self, context):
         props = context.scene.loca
         armature = context.active_object
         props.locator_positioning = False
-        sel_bones = context.selected_pose_bones
+        sel_bones = [bone.name for bone in selected_pose_bones(armature)]
+        if not sel_bones:
+            return None
+
+        st_frame = props.bake_start_fr
+        end_frame = props.bake_end_fr
 
-        if not context.scene.objects.get('wgt_loca'):
-            self.create_widget(armature)
+        # Set start and end frames to scene frame range if baking_frame_range is False
+        if not props.baking_frame_range:
+            st_frame = context.scene.frame_start
+            end_frame = context.scene.frame_end
 
-        for bone in sel_bones:
-            self.create_locator(context, bone, props)
+        self.create_widget(context)
 
-        return {'FINISHED'}
+        # Allocate all locators in one edit mode session, then set them up together in POSEMODE
+        locators = self.create_locator_bones(context, sel_bones)
+        # Rotation targets only need the location of the locator to aim at
+        if self.rt_mode or props.locator_channels == 'LOCATION':
+            channels = {'LOCATION'}
+        else:
+            channels = {'LOCATION', 'ROTATION'}
+        for bone_name, locator_name in locators:
+            register_locator(armature, locator_name, bone_name, 'ROTATION' if self.rt_mode else 'LOCATION',
+                             st_frame, end_frame, channels).pending = self.rt_mode
+        self.pending_locators = self.setup_locators(context, locators, props)
+        if not self.pending_locators:
+            return None
+
+        # Bake all locators in one sweep over the frame range
+        self.index = armature_fcurve_index(armature)
+        steps = locator_keys_steps(context.scene, armature, [(loc, bone, None) for bone, loc in self.pending_locators],
+                                   st_frame, end_frame, self.index)
+        return steps, end_frame - st_frame + 1
+
+    def bake_finish(self, context, baked):
+        armature = self.bake_armature()
+        pending_locators = self.pending_locators
+        write_baked_keys(context.scene, armature, self.index, baked)
+
+        set_armature_mode(armature, 'POSE')
+        deselect_bones(armature)
+
+        with profile_phase('add constraints'):
+            for bone_name, locator_name in pending_locators:
+                self.connect_locator(armature, bone_name, locator_name)
+                armature.pose.bones[locator_name].bone.select = True
+        armature.data.bones.active = armature.data.bones[pending_locators[-1][1]]
+        snapshot_locator_sources(armature)
+
+    def bake_rollback(self, context):
+        # Remove the locators of a cancelled bake, no keys have been written yet
+        armature = self.bake_armature()
+        locator_names = {loc for _, loc in self.pending_locators}
+        delete_locator_bones(armature, locator_names)
+        unregister_locators(armature, locator_names)
 
 # Operator to create locators for rotation target
-class Loca_OT_create_locators_RT(Operator):
+class Loca_OT_create_locators_RT(LocaModalBake, Operator):
     """Create locators for rotation target"""
 
     bl_label = 'create_locators_RT'
     bl_idname = 'bones.locators_rt'
     bl_options = {'REGISTER', 'UNDO'}
 
-    # Function to bake locator
-    def bake_locator(self, context, loc_name):
+    # Function to keep unbaked locators at their placement relative to their source bones with child of constraints,
+    # new child of constraints set their inverse on the next evaluation, so the visual transforms of the locators
+    # stay their current transforms and nothing has to be applied
+    def attach_locators(self, context, locators):
+        armature = context.active_object
+        for locator in locators:
+            child_of = armature.pose.bones[locator.name].constraints.new('CHILD_OF')
+            child_of.target = armature
+            child_of.subtarget = locator.bone
+
+    @classmethod
+    def poll(cls, context):
+        return armature_in_pose_mode(context)
+
+    def bake_prepare(self, context):
         armature = context.active_object
         props = context.scene.loca
+        props.locator_positioning = False
         st_frame = props.bake_start_fr
         end_frame = props.bake_end_fr
 
@@ -263,78 +2129,236 @@ class Loca_OT_create_locators_RT(Operator):
             st_frame = context.scene.frame_start
             end_frame = context.scene.frame_end
 
-        bone_name = loc_name.split('_LOCA')[0]
-        print('locator RT', loc_name)
-
-        locator = context.object.data.bones[loc_name]
-        locator_P = context.object.pose.bones[loc_name]
-        context.object.data.bones.active = locator
-        pose_bone = context.object.pose.bones[bone_name]
-
-        child_of = locator_P.constraints.new('CHILD_OF')
-        child_of.target = armature
-        child_of.subtarget = bone_name
-        print('constraints added')
+        locators = [locator for locator in armature.data.loca_locators
+                    if locator.pending and locator.name in armature.pose.bones and locator.bone in armature.pose.bones]
+        if not locators:
+            return None
+        self.locator_names = [locator.name for locator in locators]
+        for locator in locators:
+            locator.frame_start = st_frame
+            locator.frame_end = end_frame
+            locator.pending = False
 
         if props.without_baking:
-            bpy.ops.pose.visual_transform_apply()
-            constraint = locator_P.constraints[0]
-            locator_P.constraints.remove(constraint)
-            child_of = locator_P.constraints.new('CHILD_OF')
-            child_of.target = armature
-            child_of.subtarget = bone_name
-            print('added constraints child of for locator')
-        else:
-            # Switch to POSE mode if not already in it
-            if bpy.context.mode != "POSE":
-                bpy.ops.object.mode_set(mode='POSE')
-
-            # Deselect all bones
-            bpy.ops.pose.select_all(action='DESELECT')
-
-            # Select the specific bone
-            armature.data.bones.active = armature.data.bones[loc_name]
-            armature.pose.bones[loc_name].bone.select = True
-            bpy.ops.anim.keyframe_insert_menu(type='Location')
-
-            bpy.ops.nla.bake(frame_start=st_frame, frame_end=end_frame, only_selected=True,
-                             visual_keying=True, clear_constraints=True, use_current_action=True, bake_types={'POSE'})
-            locator_P = context.object.pose.bones[locator.name]
-            if locator_P.constraints:
-                locator_P.constraints.remove(locator_P.constraints[0])
-            hide_scale_fcurves(armature.name)
-            damped_track = pose_bone.constraints.new('DAMPED_TRACK')
-            damped_track.name = 'Damped Track to locator__Loca'
-            damped_track.target = armature
-            damped_track.subtarget = loc_name
-            damped_track.track_axis = props.axis
-
-            if bpy.context.mode != "POSE":
-                bpy.ops.object.mode_set(mode='POSE')
-
-            # Deselect all bones
-            bpy.ops.pose.select_all(action='DESELECT')
-
-            # Select the specific bone
-            armature.data.bones.active = armature.data.bones[loc_name]
-            armature.pose.bones[loc_name].bone.select = True
+            self.attach_locators(context, locators)
+            snapshot_locator_sources(armature)
+            return None
+
+        # Locators keep their placement relative to their source bones at the current frame,
+        # the offsets of all locators are computed from one read of the pose
+        bone_index, matrices = read_pose_matrices(armature)
+        sources = matrices[[bone_index[locator.bone] for locator in locators]]
+        offsets = np.linalg.inv(sources) @ matrices[[bone_index[locator.name] for locator in locators]]
+        for locator, offset in zip(locators, offsets):
+            locator.offset = offset.ravel()
+
+        # Bake all locators in one sweep over the frame range
+        self.index = armature_fcurve_index(armature)
+        steps = locator_keys_steps(context.scene, armature,
+                                   [(locator.name, locator.bone, offset) for locator, offset in zip(locators, offsets)],
+                                   st_frame, end_frame, self.index)
+        return steps, end_frame - st_frame + 1
+
+    def bake_finish(self, context, baked):
+        armature = self.bake_armature()
+        props = context.scene.loca
+        write_baked_keys(context.scene, armature, self.index, baked)
+
+        registry = locator_registry(armature)
+        with profile_phase('add constraints'):
+            for locator_name in self.locator_names:
+                locator = registry[locator_name]
+                damped_track = armature.pose.bones[locator.bone].constraints.new('DAMPED_TRACK')
+                damped_track.name = 'Damped Track to locator__Loca'
+                damped_track.target = armature
+                damped_track.subtarget = locator_name
+                damped_track.track_axis = props.axis
+                locator.constraints.add().name = damped_track.name
+
+        set_armature_mode(armature, 'POSE')
+        deselect_bones(armature)
+        for locator_name in self.locator_names:
+            armature.pose.bones[locator_name].bone.select = True
+        armature.data.bones.active = armature.data.bones[self.locator_names[-1]]
+        snapshot_locator_sources(armature)
+
+    def bake_rollback(self, context):
+        # Locators of a cancelled bake wait for placement again
+        registry = locator_registry(self.bake_armature())
+        for locator_name in self.locator_names:
+            registry[locator_name].pending = True
+        context.scene.loca.locator_positioning = True
+
+
+# Operator to re-bake locators only on the frames where the animation of their source bones changed
+class Loca_OT_refresh_locators(LocaModalBake, Operator):
+    """Re-bake locators on the frames where the animation of their source bones changed"""
+
+    bl_label = 'refresh_locators'
+    bl_idname = 'bones.refresh_locators'
+    bl_options = {'REGISTER', 'UNDO'}
 
     @classmethod
     def poll(cls, context):
-        return context.selected_pose_bones is not None
-
-    def execute(self, context):
-        props = context.scene.loca
-        props.locator_positioning = False
-
-        for locator in locators_RT_name_list:
-            self.bake_locator(context, locator)
-        locators_RT_name_list.clear()
-
-        return {'FINISHED'}
-
+        armature = context.active_object
+        return (armature is not None and armature.type == 'ARMATURE'
+                and any(locator.dirty for locator in armature.data.loca_locators))
+
+    # Generator to compute the keys of the dirty spans, locators with the same span share one sweep
+    def refresh_steps(self, scene, armature, span_locators, index):
+        baked = []
+        for (st_frame, end_frame), locators in span_locators.items():
+            baked += yield from locator_keys_steps(scene, armature, locators, st_frame, end_frame, index)
+        return baked
+
+    # Function to mute the constraints which make the source bones follow their locators, or restore them
+    def mute_constraints(self, armature, mute):
+        for (bone_name, constraint_name), muted in self.constraint_mutes.items():
+            constraint = armature.pose.bones[bone_name].constraints.get(constraint_name)
+            if constraint:
+                constraint.mute = mute or muted
+
+    def bake_prepare(self, context):
+        armature = context.active_object
+        span_locators = {}
+        self.refreshed = []
+        self.constraint_mutes = {}
+        for locator in baked_locators(armature):
+            if not locator.dirty:
+                continue
+            offset = np.array(locator.offset).reshape(4, 4) if locator.mode == 'ROTATION' else None
+            for span in locator.dirty:
+                span_locators.setdefault((span.frame_start, span.frame_end), []).append(
+                    (locator.name, locator.bone, offset))
+            constraints = armature.pose.bones[locator.bone].constraints
+            for constraint in locator.constraints:
+                if constraint.name in constraints:
+                    self.constraint_mutes[locator.bone, constraint.name] = constraints[constraint.name].mute
+            self.refreshed.append(locator.name)
+        if not span_locators:
+            return None
+
+        # Source bones are sampled with their own animation while they do not follow their locators
+        self.index = armature_fcurve_index(armature)
+        self.mute_constraints(armature, True)
+        total = sum(end_frame - st_frame + 1 for st_frame, end_frame in span_locators)
+        return self.refresh_steps(context.scene, armature, span_locators, self.index), total
+
+    def bake_finish(self, context, baked):
+        armature = self.bake_armature()
+        self.mute_constraints(armature, False)
+        write_baked_keys(context.scene, armature, self.index, baked)
+        registry = locator_registry(armature)
+        for locator_name in self.refreshed:
+            registry[locator_name].dirty.clear()
+        snapshot_locator_sources(armature)
+
+    def bake_rollback(self, context):
+        self.mute_constraints(self.bake_armature(), False)
+
+
+# Mix-in of operators which bake the source bones of locators and delete the locators, Blender registers
+# properties of mix-ins which are not bpy types only, so every operator declares its own properties
+class LocaBakeAndDelete(LocaModalBake):
+    # Function to tell whether the source bones are baked before the locators are deleted
+    def bake_enabled(self):
+        return True
+
+    def bake_range_from_locator(self, context, index, locator_names):
+        end_frames = [int(fcurve.keyframe_points[-1].co[0]) for fcurve in bone_fcurves(index, locator_names)
+                      if fcurve.keyframe_points]
+        return max(end_frames) if end_frames else context.scene.frame_end
+
+    # Function to get the registry records of the locators to bake and delete
+    def target_locators(self, context):
+        return list(context.active_object.data.loca_locators)
+
+    # Function to get the frame range to bake a bone following the given locators
+    def bake_range(self, context, index, locator_names):
+        return context.scene.frame_start, self.bake_range_from_locator(context, index, locator_names)
+
+    # Function to get the channels the loca constraints of the given locators set on their source bone
+    def bake_channels(self, context, bone_name, locators):
+        constraints = context.active_object.pose.bones[bone_name].constraints
+        channels = set()
+        for locator in locators:
+            for recorded in locator.constraints:
+                constraint = constraints.get(recorded.name)
+                if constraint is not None:
+                    channels |= constraint_channels.get(constraint.type, set())
+        return channels
+
+    # Generator to compute the keys of all source bones, bones with the same range share one sweep
+    def bake_steps(self, scene, armature, bone_ranges, index):
+        ranges = {}
+        for bone_name, bake_range in bone_ranges.items():
+            ranges.setdefault(bake_range, []).append(bone_name)
+
+        baked = []
+        for (st_frame, end_frame), bone_names in ranges.items():
+            baked += yield from pose_bone_keys_steps(scene, armature, bone_names, st_frame, end_frame, index,
+                                                     self.channel_masks)
+        return baked
+
+    def remove_constraints(self, armature, bone_name, locators):
+        bone_P = armature.pose.bones[bone_name]
+        constraint_names = {c.name for locator in locators for c in locator.constraints}
+        for constraint in [c for c in bone_P.constraints if c.name in constraint_names]:
+            bone_P.constraints.remove(constraint)
+
+    def deleteUselessFCurves(self, armature, index, locator_names):
+        action = armature.animation_data and armature.animation_data.action
+        if action:
+            for fcurve in bone_fcurves(index, locator_names):
+                action.fcurves.remove(fcurve)
+
+    def bake_prepare(self, context):
+        armature = context.active_object
 
-class Loca_OT_bake_and_delete(Operator):
+        # Group locators by their source bones
+        locators = self.target_locators(context)
+        self.locator_names = {locator.name for locator in locators}
+        self.bones_locators = {}
+        for locator in locators:
+            if locator.bone in armature.pose.bones:
+                self.bones_locators.setdefault(locator.bone, []).append(locator.name)
+
+        # F-curves are indexed once for the whole operator
+        self.index = armature_fcurve_index(armature)
+        if not self.bake_enabled():
+            self.bake_finish(context, [])
+            return None
+
+        # Only the channels set by the constraints of the locators are baked back
+        registry = locator_registry(armature)
+        self.channel_masks = {bone_name: self.bake_channels(context, bone_name, [registry[name] for name in locators])
+                              for bone_name, locators in self.bones_locators.items()}
+        bone_ranges = {bone_name: self.bake_range(context, self.index, locators)
+                       for bone_name, locators in self.bones_locators.items() if self.channel_masks[bone_name]}
+        total = sum(end_frame - start + 1 for start, end_frame in set(bone_ranges.values()))
+        return self.bake_steps(context.scene, armature, bone_ranges, self.index), total
+
+    def bake_finish(self, context, baked):
+        armature = self.bake_armature()
+        write_baked_keys(context.scene, armature, self.index, baked)
+
+        registry = locator_registry(armature)
+        with profile_phase('remove constraints'):
+            for bone_name, locator_names in self.bones_locators.items():
+                self.remove_constraints(armature, bone_name, [registry[name] for name in locator_names])
+
+        delete_locator_bones(armature, self.locator_names)
+
+        self.deleteUselessFCurves(armature, self.index, self.locator_names)
+        unregister_locators(armature, self.locator_names)
+        snapshot_locator_sources(armature)
+
+        widget_ob = bpy.data.objects.get('wgt_loca')
+        if widget_ob and not armature.data.loca_locators:
+            bpy.data.objects.remove(widget_ob)
+
+
+class Loca_OT_bake_and_delete(LocaBakeAndDelete, Operator):
     """Bake & delele all locators"""
 
     bl_label = 'bake_and_del_all_locators'
@@ -347,128 +2371,38 @@ class Loca_OT_bake_and_delete(Operator):
         default=True,
     )
 
-    def bake_range_from_locator(self, context, bone_name):
-        end_fr = context.scene.frame_end
-        armature = context.active_object.name
-        if bpy.data.objects[armature].animation_data.action:
-            for fcurve in bpy.data.objects[armature].animation_data.action.fcurves:
-                if f'{bone_name}_LOCA' in fcurve.data_path.split('"')[1]:
-                    end_fr = int(fcurve.keyframe_points[-1].co[0])
-        return end_fr
-
-    def bake(self, context, bone_name):
-        print('baking bone', bone_name)
-        armature = context.active_object
-        st_frame = context.scene.frame_start
-        end_frame = context.scene.frame_end
-        for bone in context.object.pose.bones:
-            if bone.name == bone_name:
-                bone_P = context.object.pose.bones[bone_name]
-
-                bpy.ops.pose.select_all(action='DESELECT')
-                bone = context.object.data.bones[bone_name]
-                bone.select = True
-                print('bone selected')
-                end_frame = self.bake_range_from_locator(context, bone_name)
-                if self.bake_on:
-                    bpy.ops.nla.bake(frame_start=st_frame, frame_end=end_frame, only_selected=True,
-                                     visual_keying=True, clear_constraints=False, use_current_action=True, bake_types={'POSE'})
-                    print('bone baked')
-                for constraint in bone_P.constraints:
-                    if '__Loca' in constraint.name:
-                        bone_P.constraints.remove(constraint)
-                print('deleting remaining constraints')
-                hide_scale_fcurves(armature.name, bone_name)
-
-    def deleteLocators(self, context, loc_name):
-        armature = context.active_object
-        print('deleting', loc_name)
-        for bone in armature.data.edit_bones:
-            if bone.name == loc_name:
-                armature.data.edit_bones.remove(bone)
-
-    def deleteUselessFCurves(self, context):
-        armature = context.active_object
-        if bpy.data.objects[armature.name].animation_data.action:
-            anim_fcurves = bpy.data.objects[armature.name].animation_data.action.fcurves
-            for fcurve in anim_fcurves:
-                if '_LOCA' in fcurve.data_path:
-                    anim_fcurves.remove(fcurve)
-
-
-    def execute(self, context):
-        props = context.scene.loca
-        armature = context.active_object
-
-        bones_name_list = set()
-        for bone in armature.pose.bones:
-            if '_LOCA' in bone.name:
-                bones_name_list.add(bone.name.split('_LOCA')[0])
-
-        for bone in bones_name_list:
-            self.bake(context, bone)
-
-        bpy.ops.object.mode_set(mode='EDIT')
-
-        locators_name_list = []
-        for bone in armature.pose.bones:
-            if '_LOCA' in bone.name:
-                locators_name_list.append(bone.name)
-
-        print('deleting locators', locators_name_list)
-        for loc in locators_name_list:
-            self.deleteLocators(context, loc)
-        bpy.ops.object.mode_set(mode='POSE')
-
-        for bone in armature.data.bones:
-            if '_LOCA' in bone.name:
-                print('bone with "_LOCA"', bone.name)
-                self.deleteLocators(context, bone.name)
-
-        self.deleteUselessFCurves(context)
-
-        widget_ob = bpy.data.objects['wgt_loca']
-        bpy.data.objects.remove(widget_ob)
-
-        bones_name_list.clear()
-        locators_name_list.clear()
-        locators_RT_name_list.clear()
+    @classmethod
+    def poll(cls, context):
+        return armature_in_pose_mode(context)
 
-        return {'FINISHED'}
+    def bake_enabled(self):
+        return self.bake_on
 
 
-class Loca_OT_bake_selected_locators(Operator):
+# Operator to bake only the source bones of the selected locators and delete these locators
+class Loca_OT_bake_selected_locators(LocaBakeAndDelete, Operator):
     """Bake selected locators"""
 
     bl_label = 'bake_selected_locators'
     bl_idname = 'bones.bake_selected_locators'
     bl_options = {'REGISTER', 'UNDO'}
 
-    def execute(self, context):
-        armature = context.active_object
-        props = context.scene.loca
-        st_frame = props.bake_start_fr
-        end_frame = props.bake_end_fr
-
-        # Set start and end frames to scene frame range if baking_frame_range is False
-        if not props.baking_frame_range:
-            st_frame = context.scene.frame_start
-            end_frame = context.scene.frame_end
-
-        # selected_locators = [bone.name for bone in context.selected_pose_bones if 'LOCA' in bone.name]
-        selected_locators = [bone.name.split('_LOCA')[0] for bone in context.selected_pose_bones if 'LOCA' in bone.name]
+    @classmethod
+    def poll(cls, context):
+        return armature_in_pose_mode(context)
 
-        bpy.ops.object.mode_set(mode='POSE')
-        for loc in selected_locators:
-            bpy.context.object.data.bones.active = bpy.context.object.data.bones[loc]
-            bpy.ops.nla.bake(
-                frame_start=st_frame, frame_end=end_frame,
-                only_selected=False, visual_keying=True,
-                clear_constraints=True, use_current_action=True,
-                bake_types={'POSE'}
-            )
+    # Function to get the selected locators and the locators of selected source bones
+    def target_locators(self, context):
+        selected = {bone.name for bone in selected_pose_bones(context.active_object)}
+        return [locator for locator in context.active_object.data.loca_locators
+                if locator.name in selected or locator.bone in selected]
 
-        return {'FINISHED'}
+    def bake_range(self, context, index, locator_names):
+        props = context.scene.loca
+        # Bake in the scene frame range if baking_frame_range is False
+        if not props.baking_frame_range:
+            return context.scene.frame_start, context.scene.frame_end
+        return props.bake_start_fr, props.bake_end_fr
 
 class Loca_OT_delete_selected_locators(Operator):
     """Delete selected locators"""
@@ -477,25 +2411,19 @@ class Loca_OT_delete_selected_locators(Operator):
     bl_idname = 'bones.delete_selected_locators'
     bl_options = {'REGISTER', 'UNDO'}
 
-    def delete_locators(self, context, loc_name):
-        armature = context.active_object
-        for bone in armature.data.edit_bones:
-            if bone.name == loc_name:
-                armature.data.edit_bones.remove(bone)
+    @classmethod
+    def poll(cls, context):
+        return armature_in_pose_mode(context)
 
+    @profiled
     def execute(self, context):
         armature = context.active_object
-        selected_bones = context.selected_pose_bones
-        locators_to_delete = []
-
-        for bone in selected_bones:
-            if '_LOCA' in bone.name:
-                locators_to_delete.append(bone.name)
-
-        bpy.ops.object.mode_set(mode='EDIT')
-        for loc in locators_to_delete:
-            self.delete_locators(context, loc)
-        bpy.ops.object.mode_set(mode='POSE')
+        selected_bones = selected_pose_bones(armature)
+        registry = locator_registry(armature)
+        locators_to_delete = {bone.name for bone in selected_bones if bone.name in registry}
+        delete_locator_bones(armature, locators_to_delete)
+        unregister_locators(armature, locators_to_delete)
+        snapshot_locator_sources(armature)
 
         return {'FINISHED'}
 
@@ -509,16 +2437,14 @@ class OBJECT_PT_loca(Panel):
     def draw(self, context):
 
         props = context.scene.loca
-        is_any_locator = False
-        for bone in context.object.pose.bones:
-            if 'LOCA' in bone.name:
-                is_any_locator = True
+        is_any_locator = context.object.type == 'ARMATURE' and locator_count(context.object) > 0
 
         if context.object.mode == 'POSE':
             layout = self.layout
             col = layout.column()
             if not props.locator_positioning:
                 col.prop(props, "without_baking", text='without baking')
+                col.prop(props, "locator_channels", text='')
                 col1 = col.column(align=True)
                 col1.operator(Loca_OT_create_locators.bl_idname,
                               text="location target").rt_mode = False
@@ -535,6 +2461,8 @@ class OBJECT_PT_loca(Panel):
                     row2.operator(Loca_OT_bake_and_delete.bl_idname,
                                   text="delete all").bake_on = False
                     row2.operator(Loca_OT_delete_selected_locators.bl_idname, text="delete selected")
+                    if any(locator.dirty for locator in context.object.data.loca_locators):
+                        col1.operator(Loca_OT_refresh_locators.bl_idname, text="refresh locators")
             else:
                 col.prop(props, "select_axis", text='select local axis')
                 if props.select_axis:
@@ -557,12 +2485,40 @@ class OBJECT_PT_loca(Panel):
                 row.prop(props, "bake_start_fr")
                 row.prop(props, "bake_end_fr")
 
+            col1 = col.column(align=True)
+            row = col1.row(align=True)
+            row.prop(props, "bake_sampling", text='')
+            if props.bake_sampling == 'STEP':
+                row.prop(props, "bake_step")
+            col1.prop(props, "bake_workers")
+            col1.prop(props, "isolated_evaluation")
+            col1.prop(props, "bake_memory_limit")
+            col1.prop(props, "sample_cache_size")
+            col1.prop(props, "bake_cache_size")
+            if props.reduce_keys or props.bake_sampling == 'ADAPTIVE':
+                box = col1.box()
+                box.prop(props, "reduce_keys", text='Reduce keys')
+                row = box.row(align=True)
+                row.prop(props, "reduce_location_tolerance")
+                row.prop(props, "reduce_rotation_tolerance")
+            else:
+                col1.prop(props, "reduce_keys", text='Reduce keys')
+
+            col1 = col.column(align=True)
+            col1.prop(props, "profile", text='Profile')
+            if props.profile:
+                col1.prop(props, "profile_path", text='')
+
 
 classes = [
+    locaConstraint,
+    locaFrameSpan,
+    locaLocator,
     locaProps,
     Loca_OT_get_preview_range,
     Loca_OT_create_locators,
     Loca_OT_create_locators_RT,
+    Loca_OT_refresh_locators,
     Loca_OT_bake_and_delete,
     Loca_OT_bake_selected_locators,
     Loca_OT_delete_selected_locators,
@@ -575,9 +2531,21 @@ def register():
         register_class(cl)
 
     bpy.types.Scene.loca = PointerProperty(type=locaProps)
+    bpy.types.Armature.loca_locators = CollectionProperty(type=locaLocator)
+    bpy.app.handlers.depsgraph_update_post.append(loca_depsgraph_update)
+    bpy.app.handlers.load_post.append(loca_load_post)
+    bpy.app.handlers.save_post.append(loca_save_post)
 
 
 def unregister():
+    bpy.app.handlers.save_post.remove(loca_save_post)
+    bpy.app.handlers.load_post.remove(loca_load_post)
+    bpy.app.handlers.depsgraph_update_post.remove(loca_depsgraph_update)
+    locator_cache.clear()
+    key_snapshots.clear()
+    bake_cache.clear()
+    pose_sample_cache.clear()
+    del bpy.types.Armature.loca_locators
     for cl in reversed(classes):
         unregister_class(cl)
 
@@ -0,0 +1,54 @@
+# Background bake worker of loca.
+# The add-on runs it as `blender -b snapshot.blend --python bake_worker.py -- job.json` for every chunk of
+# the bake range. It samples pose space matrices of the job's bones on the job's frames and writes them
+# to a memory-mapped .npy file of shape (frames, bones, 4, 4) which the add-on merges into its bake,
+# the number of finished frames is kept in the job's progress file.
+import importlib.util
+import json
+import os
+import sys
+
+import bpy
+import numpy as np
+
+
+# Function to load the evaluation helpers of the add-on, the worker runs outside of its package
+def load_evaluation():
+    spec = importlib.util.spec_from_file_location(
+        'loca_evaluation', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'evaluation.py'))
+    evaluation = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(evaluation)
+    return evaluation
+
+
+evaluation = load_evaluation()
+
+
+# Function to sample pose matrices of the bones of a job on its frames
+def sample_job(job):
+    scene = bpy.data.scenes[job['scene']]
+    view_layer = scene.view_layers[job['view_layer']]
+    if job.get('objects'):
+        scene = evaluation.isolated_scene(scene, [bpy.data.objects[name] for name in job['objects']])
+        view_layer = scene.view_layers[0]
+    armature = bpy.data.objects[job['armature']]
+    frames = np.load(job['frames_path'])
+
+    bone_index = {bone.name: i for i, bone in enumerate(armature.pose.bones)}
+    indices = [bone_index[name] for name in job['bones']]
+    buffer = np.empty(len(bone_index) * 16, dtype=np.float32)
+    output = np.lib.format.open_memmap(job['output_path'], mode='w+', dtype=np.float32,
+                                       shape=(len(frames), len(indices), 4, 4))
+
+    for i, frame in enumerate(frames):
+        scene.frame_set(int(frame))
+        pose_bones = armature.evaluated_get(view_layer.depsgraph).pose.bones
+        output[i] = evaluation.pose_matrices(pose_bones, buffer)[indices]
+        with open(job['progress_path'], 'w') as progress_file:
+            progress_file.write(str(i + 1))
+    output.flush()
+
+
+if __name__ == "__main__":
+    with open(sys.argv[sys.argv.index('--') + 1]) as job_file:
+        sample_job(json.load(job_file))
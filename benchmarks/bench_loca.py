@@ -0,0 +1,191 @@
+# Benchmark of loca operators on synthetic rigs.
+# Run headless from the repository root:
+#   blender -b --factory-startup --python benchmarks/bench_loca.py -- --bones 100 500 --frames 250 2000 \
+#       --output bench.json
+# Every combination of bone count and frame count gets a fresh armature made of chains of --depth bones,
+# keyed every --key-step frames. The public operators are timed on it and the timings are written to JSON,
+# so runs can be compared over time. An operator which fails is recorded with its error instead of a timing,
+# the run goes on and exits with status 1 at the end.
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import sys
+import time
+
+import bpy
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Function to register the add-on from this repository
+def load_addon():
+    spec = importlib.util.spec_from_file_location(
+        'loca', os.path.join(REPO_DIR, '__init__.py'), submodule_search_locations=[REPO_DIR])
+    addon = importlib.util.module_from_spec(spec)
+    sys.modules['loca'] = addon
+    spec.loader.exec_module(addon)
+    addon.register()
+    return addon
+
+
+# Function to parse arguments given after '--'
+def parse_args():
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    parser = argparse.ArgumentParser(description="Benchmark loca operators on synthetic rigs")
+    parser.add_argument('--bones', type=int, nargs='+', default=[100, 500, 2000])
+    parser.add_argument('--frames', type=int, nargs='+', default=[250, 2000, 10000])
+    parser.add_argument('--depth', type=int, default=4, help="number of bones in every chain")
+    parser.add_argument('--key-step', type=int, default=5, help="frames between keys of the source animation")
+    parser.add_argument('--locators', type=int, default=10, help="number of locators created per operator")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_loca.json')
+    return parser.parse_args(argv)
+
+
+# Function to create an armature of chains of bones with random keys on location and rotation
+def build_rig(bone_count, depth, frame_count, key_step, rng):
+    for ob in list(bpy.data.objects):
+        bpy.data.objects.remove(ob)
+    scene = bpy.context.scene
+    scene.frame_start = 1
+    scene.frame_end = frame_count
+
+    armature_data = bpy.data.armatures.new('bench_rig')
+    armature = bpy.data.objects.new('bench_rig', armature_data)
+    scene.collection.objects.link(armature)
+    bpy.context.view_layer.objects.active = armature
+
+    with bpy.context.temp_override(active_object=armature, object=armature):
+        bpy.ops.object.mode_set(mode='EDIT')
+        for i in range(bone_count):
+            bone = armature_data.edit_bones.new(f'bone_{i:05d}')
+            chain, link = divmod(i, depth)
+            bone.head = (chain * 0.5, 0.0, link * 1.0)
+            bone.tail = (chain * 0.5, 0.0, link * 1.0 + 1.0)
+            if link:
+                bone.parent = armature_data.edit_bones[f'bone_{i - 1:05d}']
+                bone.use_connect = True
+        bpy.ops.object.mode_set(mode='POSE')
+
+    # Write the source animation in bulk
+    action = bpy.data.actions.new('bench_action')
+    armature.animation_data_create().action = action
+    key_frames = np.arange(1, frame_count + 1, key_step, dtype=np.float32)
+    for pose_bone in armature.pose.bones:
+        pose_bone.rotation_mode = 'XYZ'
+        for data_path, count, amplitude in (('location', 3, 0.2), ('rotation_euler', 3, 0.5)):
+            if data_path == 'location' and pose_bone.parent:
+                continue
+            for index in range(count):
+                fcurve = action.fcurves.new(f'pose.bones["{pose_bone.name}"].{data_path}', index=index,
+                                            action_group=pose_bone.name)
+                co = np.empty((len(key_frames), 2), dtype=np.float32)
+                co[:, 0] = key_frames
+                co[:, 1] = rng.uniform(-amplitude, amplitude, len(key_frames))
+                fcurve.keyframe_points.add(len(key_frames))
+                fcurve.keyframe_points.foreach_set('co', co.ravel())
+                fcurve.update()
+    return armature
+
+
+# Function to select pose bones by name
+def select_bones(armature, bone_names):
+    bone_names = set(bone_names)
+    for bone in armature.data.bones:
+        bone.select = bone.name in bone_names
+
+
+# Function to time one operator call with the given pose bones selected
+def run_operator(armature, operator, bone_names, **kwargs):
+    select_bones(armature, bone_names)
+    with bpy.context.temp_override(active_object=armature, object=armature):
+        start = time.perf_counter()
+        result = operator('EXEC_DEFAULT', **kwargs)
+        elapsed = time.perf_counter() - start
+    if 'FINISHED' not in result:
+        raise RuntimeError(f"{operator.idname_py()} returned {result}")
+    return elapsed
+
+
+# Function to time every public operator on one synthetic rig, returns the timings and the errors by operator
+def bench_rig(addon, armature, locator_count):
+    props = bpy.context.scene.loca
+    props.baking_frame_range = False
+    timings = {}
+    errors = {}
+    bone_names = [bone.name for bone in armature.pose.bones]
+    step = max(len(bone_names) // locator_count, 1)
+    sources = bone_names[::step][:locator_count]
+
+    def timed(name, operator, bone_names, **kwargs):
+        try:
+            timings[name] = run_operator(armature, operator, bone_names, **kwargs)
+        except Exception as error:
+            errors[name] = f"{type(error).__name__}: {error}"
+            print(f"loca bench: {name} failed: {errors[name]}")
+
+    timed('bones.locators', bpy.ops.bones.locators, sources, rt_mode=False)
+    locators = [locator.name for locator in armature.data.loca_locators]
+    timed('bones.bake_selected_locators', bpy.ops.bones.bake_selected_locators,
+          locators[:max(len(locators) // 2, 1)])
+    locators = [locator.name for locator in armature.data.loca_locators]
+    timed('bones.delete_selected_locators', bpy.ops.bones.delete_selected_locators,
+          locators[:max(len(locators) // 2, 1)])
+    timed('bones.bake_and_del', bpy.ops.bones.bake_and_del, [], bake_on=True)
+
+    timed('bones.locators (rotation target)', bpy.ops.bones.locators, sources, rt_mode=True)
+    locators = [locator.name for locator in armature.data.loca_locators]
+    timed('bones.locators_rt', bpy.ops.bones.locators_rt, locators)
+    timed('bones.bake_and_del (delete only)', bpy.ops.bones.bake_and_del, [], bake_on=False)
+    return timings, errors
+
+
+def main():
+    args = parse_args()
+    addon = load_addon()
+    rng = np.random.default_rng(args.seed)
+    report = {
+        'loca_version': '.'.join(map(str, addon.bl_info['version'])),
+        'blender_version': bpy.app.version_string,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': vars(args),
+        'results': [],
+    }
+
+    failed = False
+    for bone_count in args.bones:
+        for frame_count in args.frames:
+            build_start = time.perf_counter()
+            armature = build_rig(bone_count, args.depth, frame_count, args.key_step, rng)
+            build_time = time.perf_counter() - build_start
+            timings, errors = bench_rig(addon, armature, args.locators)
+            failed = failed or bool(errors)
+            result = {
+                'bones': bone_count,
+                'depth': args.depth,
+                'frames': frame_count,
+                'key_step': args.key_step,
+                'locators': args.locators,
+                'build_time': build_time,
+                'timings': timings,
+                'errors': errors,
+            }
+            report['results'].append(result)
+            print(f"loca bench: {bone_count} bones x {frame_count} frames: "
+                  + ', '.join(f"{name} {seconds:.3f}s" for name, seconds in result['timings'].items()))
+
+            # Write after every rig, so long runs leave partial results behind
+            with open(args.output, 'w') as output:
+                json.dump(report, output, indent=2)
+
+    addon.unregister()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
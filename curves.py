@@ -0,0 +1,198 @@
+# Curve math of loca bakes.
+# Conversion of sampled rotations to continuous channels and reduction of sampled channels to Bezier keys,
+# in one pass or streamed window by window. Everything but the Euler conversion, which needs mathutils,
+# only uses NumPy and also runs outside of Blender.
+import numpy as np
+
+
+# Maximum number of samples covered by one segment of reduced keys
+REDUCE_MAX_SEGMENT = 256
+
+# Function to convert rotation matrices to continuous quaternions, continuity carries the signs on from
+# the previous window of a streamed bake and is updated for the next one
+def rotations_to_quaternions(rotations, continuity=None):
+    m = rotations
+    trace = m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2]
+    case = np.argmax(np.stack((trace, m[:, 0, 0], m[:, 1, 1], m[:, 2, 2]), axis=1), axis=1)
+    quats = np.empty((len(m), 4))
+
+    c = case == 0
+    s = np.sqrt(np.maximum(trace[c] + 1.0, 0.0)) * 2.0
+    quats[c] = np.stack((0.25 * s, (m[c, 2, 1] - m[c, 1, 2]) / s,
+                         (m[c, 0, 2] - m[c, 2, 0]) / s, (m[c, 1, 0] - m[c, 0, 1]) / s), axis=1)
+    c = case == 1
+    s = np.sqrt(np.maximum(1.0 + m[c, 0, 0] - m[c, 1, 1] - m[c, 2, 2], 0.0)) * 2.0
+    quats[c] = np.stack(((m[c, 2, 1] - m[c, 1, 2]) / s, 0.25 * s,
+                         (m[c, 0, 1] + m[c, 1, 0]) / s, (m[c, 0, 2] + m[c, 2, 0]) / s), axis=1)
+    c = case == 2
+    s = np.sqrt(np.maximum(1.0 + m[c, 1, 1] - m[c, 0, 0] - m[c, 2, 2], 0.0)) * 2.0
+    quats[c] = np.stack(((m[c, 0, 2] - m[c, 2, 0]) / s, (m[c, 0, 1] + m[c, 1, 0]) / s,
+                         0.25 * s, (m[c, 1, 2] + m[c, 2, 1]) / s), axis=1)
+    c = case == 3
+    s = np.sqrt(np.maximum(1.0 + m[c, 2, 2] - m[c, 0, 0] - m[c, 1, 1], 0.0)) * 2.0
+    quats[c] = np.stack(((m[c, 1, 0] - m[c, 0, 1]) / s, (m[c, 0, 2] + m[c, 2, 0]) / s,
+                         (m[c, 1, 2] + m[c, 2, 1]) / s, 0.25 * s), axis=1)
+
+    quats /= np.linalg.norm(quats, axis=1)[:, None]
+    if continuity and 'quaternion' in continuity:
+        previous, sign = continuity['quaternion']
+    else:
+        if quats[0, 0] < 0:
+            quats[0] = -quats[0]
+        previous, sign = quats[0], 1.0
+    # Flip signs so that neighbouring keys take the shortest path
+    flips = np.where(np.einsum('ij,ij->i', quats, np.concatenate(([previous], quats[:-1]))) < 0, -1.0, 1.0)
+    signs = sign * np.cumprod(flips)
+    if continuity is not None:
+        continuity['quaternion'] = (quats[-1].copy(), signs[-1])
+    return quats * signs[:, None]
+
+# Function to convert rotation matrices to compatible Euler angles in the given order, continuity carries the
+# angles on from the previous window of a streamed bake and is updated for the next one
+def rotations_to_eulers(rotations, order, continuity=None):
+    # mathutils only exists inside Blender, the other functions of this module also run outside of it
+    from mathutils import Matrix
+
+    eulers = []
+    euler = continuity.get('euler') if continuity else None
+    for rotation in rotations:
+        euler = Matrix(rotation).to_euler(order, euler) if euler is not None else Matrix(rotation).to_euler(order)
+        eulers.append(euler)
+    if continuity is not None:
+        continuity['euler'] = euler
+    return np.array(eulers)
+
+# Function to fit one cubic Bezier segment with fixed end keys to samples, handles lie at thirds
+# of the segment in time, so the curve parameter is linear in time and the fit is linear least squares
+def fit_bezier_segment(times, values):
+    u = (times - times[0]) / (times[-1] - times[0])
+    basis = np.stack(((1 - u) ** 3, 3 * u * (1 - u) ** 2, 3 * u ** 2 * (1 - u), u ** 3), axis=1)
+    start, end = values[0], values[-1]
+    linear = np.stack((start + (end - start) / 3, start + (end - start) * 2 / 3))
+
+    # Small regularization towards straight handles keeps short segments well defined
+    inner = basis[:, 1:3]
+    rhs = values - np.outer(basis[:, 0], start) - np.outer(basis[:, 3], end)
+    handles = np.linalg.solve(inner.T @ inner + 1e-6 * np.eye(2), inner.T @ rhs + 1e-6 * linear)
+    fitted = np.outer(basis[:, 0], start) + inner @ handles + np.outer(basis[:, 3], end)
+    return handles, fitted
+
+# Function to measure the error of fitted samples, distance for locations and angle for rotations
+def fit_error(metric, fitted, values):
+    if metric == 'QUATERNION':
+        fitted = fitted / np.linalg.norm(fitted, axis=1)[:, None]
+        dots = np.abs(np.einsum('ij,ij->i', fitted, values / np.linalg.norm(values, axis=1)[:, None]))
+        return 2 * np.arccos(np.clip(dots, 0.0, 1.0))
+    if metric == 'DISTANCE':
+        return np.linalg.norm(fitted - values, axis=1)
+    return np.abs(fitted - values).max(axis=1)
+
+# Function to find the longest segment from a key that fits the samples within tolerance,
+# only samples up to REDUCE_MAX_SEGMENT after the key are looked at
+def fit_next_segment(times, values, start, tolerance, metric):
+    last = min(len(times) - 1, start + REDUCE_MAX_SEGMENT)
+    good = start + 1
+    good_handles = fit_bezier_segment(times[start:good + 1], values[start:good + 1])[0]
+    bad = None
+
+    def fits(end):
+        handles, fitted = fit_bezier_segment(times[start:end + 1], values[start:end + 1])
+        return fit_error(metric, fitted, values[start:end + 1]).max() <= tolerance, handles
+
+    # Grow the segment exponentially, then bisect between the last good and the first bad end
+    span = 2
+    while good < last:
+        end = min(start + span, last)
+        ok, handles = fits(end)
+        if not ok:
+            bad = end
+            break
+        good, good_handles = end, handles
+        span *= 2
+    while bad is not None and bad - good > 1:
+        end = (good + bad) // 2
+        ok, handles = fits(end)
+        if ok:
+            good, good_handles = end, handles
+        else:
+            bad = end
+    return good, good_handles
+
+# Function to turn reduced segments into key values and (keys, components, 2) handle arrays
+def bezier_keys(times, values, keys, segment_handles):
+    keys = np.asarray(keys)
+    key_times = times[keys]
+    key_values = values[keys]
+    handles = np.array(segment_handles).reshape(-1, 2, values.shape[1])
+    durations = np.diff(key_times)[:, None]
+
+    handles_left = np.empty((len(keys), values.shape[1], 2))
+    handles_right = np.empty((len(keys), values.shape[1], 2))
+    handles_right[:-1, :, 0] = key_times[:-1, None] + durations / 3
+    handles_right[:-1, :, 1] = handles[:, 0]
+    handles_left[1:, :, 0] = key_times[1:, None] - durations / 3
+    handles_left[1:, :, 1] = handles[:, 1]
+
+    # Outer handles mirror the inner ones
+    first = np.stack((np.full(values.shape[1], key_times[0]), key_values[0]), axis=1)
+    last = np.stack((np.full(values.shape[1], key_times[-1]), key_values[-1]), axis=1)
+    handles_left[0] = 2 * first - handles_right[0]
+    handles_right[-1] = 2 * last - handles_left[-1]
+    return key_times, key_values, handles_left, handles_right
+
+# Function to reduce sampled keys of a channel to Bezier keys within tolerance, values are
+# (samples, components) arrays, returns key frames, key values and free handles per component
+def reduce_keys(frames, values, tolerance, metric):
+    times = np.asarray(frames, dtype=np.float64)
+    keys = [0]
+    segment_handles = []
+    while keys[-1] < len(times) - 1:
+        end, handles = fit_next_segment(times, values, keys[-1], tolerance, metric)
+        keys.append(end)
+        segment_handles.append(handles)
+    return bezier_keys(times, values, keys, segment_handles)
+
+# Reduction of one channel fed with samples window by window, a segment is fitted once REDUCE_MAX_SEGMENT
+# samples follow its first key, so the keys are the same as those of reduce_keys on all samples at once
+class KeyStream:
+    def __init__(self, reduction=None):
+        self.reduction = reduction
+        self.times = np.empty(0)
+        self.values = None
+        # The last two keys and the segment between them are kept to join the keys of the next window
+        self.key_times = []
+        self.key_values = []
+        self.segment_handles = []
+        self.unwritten = 0
+
+    # Function to add the samples of a window, returns keys to write as in reduce_keys or None, the first
+    # returned key replaces the last key written before as its right handle is only known now
+    def append(self, frames, values, final=False):
+        times = np.concatenate((self.times, np.asarray(frames, dtype=np.float64)))
+        values = values if self.values is None else np.concatenate((self.values, values))
+        if not self.reduction:
+            self.times, self.values = times[-1:], values[-1:]
+            return times, values, None, None
+
+        metric, tolerance = self.reduction
+        if not self.key_times:
+            self.key_times.append(times[0])
+            self.key_values.append(values[0])
+            self.unwritten = 1
+        start = 0
+        while len(times) - start > REDUCE_MAX_SEGMENT or (final and start < len(times) - 1):
+            start, handles = fit_next_segment(times, values, start, tolerance, metric)
+            self.key_times.append(times[start])
+            self.key_values.append(values[start])
+            self.segment_handles.append(handles)
+            self.unwritten += 1
+        self.times, self.values = times[start:], values[start:]
+        if not self.unwritten or not self.segment_handles:
+            return None
+
+        first = max(len(self.key_times) - self.unwritten - 1, 0)
+        key_times = np.array(self.key_times)
+        keys = bezier_keys(key_times, np.array(self.key_values), np.arange(len(key_times)), self.segment_handles)
+        del self.key_times[:-2], self.key_values[:-2], self.segment_handles[:-1]
+        self.unwritten = 0
+        return tuple(array[first:] for array in keys)
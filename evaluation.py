@@ -0,0 +1,26 @@
+# Scene evaluation of loca bakes.
+# Shared by the add-on and bake_worker.py, which runs as a script in background Blender and loads this file
+# by its path, so nothing here imports from the add-on package.
+import bpy
+
+
+# Function to create a temporary scene holding only the given objects with the timing of the scene, frames
+# set in it evaluate just these objects, the caller removes it with bpy.data.scenes.remove
+def isolated_scene(scene, objects):
+    isolated = bpy.data.scenes.new(f'{scene.name}__Loca')
+    isolated.render.fps = scene.render.fps
+    isolated.render.fps_base = scene.render.fps_base
+    isolated.render.frame_map_old = scene.render.frame_map_old
+    isolated.render.frame_map_new = scene.render.frame_map_new
+    for ob in objects:
+        isolated.collection.objects.link(ob)
+    # A new scene has no depsgraph until its view layer is updated
+    isolated.view_layers[0].update()
+    return isolated
+
+# Function to read the pose space matrices of all pose bones through a buffer of 16 floats per bone,
+# returns them as a (bones, 4, 4) view of the buffer
+def pose_matrices(pose_bones, buffer):
+    pose_bones.foreach_get('matrix', buffer)
+    # foreach_get returns matrices column by column
+    return buffer.reshape(-1, 4, 4).transpose(0, 2, 1)
@@ -0,0 +1,67 @@
+# Background bake jobs of loca.
+# The frames of a parallel bake are split into chunks, every chunk is written as a job file and handed
+# to a worker started by a launcher. Workers follow the protocol of bake_worker.py: they count their
+# finished frames in the job's progress file and write their samples to the job's .npy output.
+# Nothing here uses bpy, so the protocol runs with any launcher, Blender or a Python stand-in.
+import json
+import os
+
+import numpy as np
+
+
+# Function to read the number of frames a worker has finished, a file being rewritten reads as None
+def read_progress(progress_path):
+    try:
+        with open(progress_path) as progress_file:
+            return int(progress_file.read())
+    except (OSError, ValueError):
+        return None
+
+# Generator to sample frames with one job per chunk in the given directory, job holds the fields shared by all
+# jobs, launchers take the snapshot and job file paths and return a Popen-like process, yields the number of
+# frames finished since the last yield while the workers run and returns the (frames, bones, 4, 4) samples
+def run_sample_jobs_steps(directory, snapshot, job, frames, workers, launcher):
+    chunks = [chunk for chunk in np.array_split(np.asarray(frames), workers) if len(chunk)]
+    jobs = []
+    processes = []
+    try:
+        for i, chunk in enumerate(chunks):
+            chunk_job = dict(job,
+                             frames_path=os.path.join(directory, f'frames_{i}.npy'),
+                             output_path=os.path.join(directory, f'samples_{i}.npy'),
+                             progress_path=os.path.join(directory, f'progress_{i}.txt'))
+            np.save(chunk_job['frames_path'], chunk)
+            job_path = os.path.join(directory, f'job_{i}.json')
+            with open(job_path, 'w') as job_file:
+                json.dump(chunk_job, job_file)
+            jobs.append((chunk_job, job_path))
+            processes.append(launcher(snapshot, job_path))
+
+        # Progress is reported as frames finished by all workers, waiting is left to the caller
+        reported = 0
+        progress = [0] * len(jobs)
+        while any(process.poll() is None for process in processes):
+            for i, (chunk_job, _) in enumerate(jobs):
+                progress[i] = max(progress[i], read_progress(chunk_job['progress_path']) or 0)
+            finished = sum(progress)
+            yield finished - reported
+            reported = finished
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    samples = np.empty((len(frames), len(job['bones']), 4, 4))
+    start = 0
+    for chunk, (chunk_job, job_path), process in zip(chunks, jobs, processes):
+        if process.returncode != 0 or not os.path.exists(chunk_job['output_path']):
+            log_path = f'{job_path}.log'
+            log = ''
+            if os.path.exists(log_path):
+                with open(log_path) as log_file:
+                    log = log_file.read()[-2000:]
+            raise RuntimeError(f"Bake worker for frames {chunk[0]}-{chunk[-1]} failed\n{log}")
+        samples[start:start + len(chunk)] = np.load(chunk_job['output_path'], mmap_mode='r')
+        start += len(chunk)
+    return samples
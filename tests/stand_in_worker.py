@@ -0,0 +1,24 @@
+# Python stand-in for bake_worker.py in tests of the job protocol.
+# Run as `python stand_in_worker.py job.json`, it answers every frame with matrices filled with the frame
+# number instead of evaluating a rig.
+import json
+import sys
+
+import numpy as np
+
+
+# Function to write stand-in samples of a job following the protocol of bake_worker.py
+def sample_job(job):
+    frames = np.load(job['frames_path'])
+    output = np.lib.format.open_memmap(job['output_path'], mode='w+', dtype=np.float32,
+                                       shape=(len(frames), len(job['bones']), 4, 4))
+    for i, frame in enumerate(frames):
+        output[i] = frame
+        with open(job['progress_path'], 'w') as progress_file:
+            progress_file.write(str(i + 1))
+    output.flush()
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) as job_file:
+        sample_job(json.load(job_file))
@@ -0,0 +1,109 @@
+# Tests that streamed bakes match single pass bakes, run without Blender by
+# `python -m unittest discover -s tests`
+import importlib.util
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from curves import (REDUCE_MAX_SEGMENT, KeyStream, reduce_keys, rotations_to_eulers,  # noqa: E402
+                    rotations_to_quaternions)
+
+
+# Function to feed samples to a key stream in windows ending at the given cuts, the first key returned
+# for a window replaces the last key returned before as in StagedBake
+def stream_keys(reduction, frames, values, cuts):
+    stream = KeyStream(reduction)
+    bounds = [0, *cuts, len(frames)]
+    keys = None
+    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        window = stream.append(frames[start:end], values[start:end], final=end == len(frames))
+        if window is None:
+            continue
+        if keys is None:
+            keys = window
+        else:
+            keys = tuple(None if old is None else np.concatenate((old[:-1], new)) for old, new in zip(keys, window))
+    return keys
+
+
+# Function to get rotation matrices of random walks of quaternions
+def random_rotations(rng, count):
+    w, x, y, z = np.cumsum(rng.normal(size=(count, 4)) * 0.4, axis=0).T
+    norm = np.sqrt(w * w + x * x + y * y + z * z)
+    w, x, y, z = w / norm, x / norm, y / norm, z / norm
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)], axis=1),
+        np.stack([2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)], axis=1),
+        np.stack([2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)], axis=1)], axis=1)
+
+
+class KeyStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(7)
+
+    def assert_streamed_equal(self, reduction, frames, values, cuts):
+        metric, tolerance = reduction
+        expected = reduce_keys(frames, values, tolerance, metric)
+        streamed = stream_keys(reduction, frames, values, cuts)
+        for expected_array, streamed_array in zip(expected, streamed):
+            np.testing.assert_array_equal(streamed_array, expected_array)
+
+    def test_noisy_curves_match_single_pass(self):
+        for count in (300, 1200, 3001):
+            frames = np.arange(count) * 2
+            values = np.cumsum(self.rng.normal(size=(count, 3)) * 0.05, axis=0) + np.sin(frames / 30)[:, None]
+            cuts = sorted(set(self.rng.integers(1, count, size=8).tolist()))
+            for reduction in (('DISTANCE', 0.01), ('EULER', 0.001)):
+                with self.subTest(count=count, reduction=reduction):
+                    self.assert_streamed_equal(reduction, frames, values, cuts)
+
+    def test_segments_at_the_lookahead_limit_match_single_pass(self):
+        frames = np.arange(5000)
+        values = np.stack([np.sin(frames / 400), np.cos(frames / 300), frames / 1000], axis=1)
+        cuts = [1, 2, REDUCE_MAX_SEGMENT, REDUCE_MAX_SEGMENT + 1, 1400, 4000]
+        self.assert_streamed_equal(('DISTANCE', 0.05), frames, values, cuts)
+
+    def test_quaternion_keys_match_single_pass(self):
+        frames = np.arange(2000)
+        values = rotations_to_quaternions(random_rotations(self.rng, len(frames)))
+        self.assert_streamed_equal(('QUATERNION', 0.002), frames, values, [500, 501, 1700])
+
+    def test_unreduced_windows_overlap_by_their_last_key(self):
+        frames = np.arange(0, 100, 3)
+        values = self.rng.normal(size=(len(frames), 3))
+        key_frames, key_values, handles_left, handles_right = stream_keys(None, frames, values, [5, 6, 20])
+        np.testing.assert_array_equal(key_frames, frames)
+        np.testing.assert_array_equal(key_values, values)
+        self.assertIsNone(handles_left)
+        self.assertIsNone(handles_right)
+
+
+class ContinuityTest(unittest.TestCase):
+    def setUp(self):
+        self.rotations = random_rotations(np.random.default_rng(11), 600)
+        self.cuts = [1, 2, 150, 599]
+
+    def test_quaternion_signs_continue_across_windows(self):
+        expected = rotations_to_quaternions(self.rotations.copy())
+        continuity = {}
+        bounds = [0, *self.cuts, len(self.rotations)]
+        streamed = np.concatenate([rotations_to_quaternions(self.rotations[start:end].copy(), continuity)
+                                   for start, end in zip(bounds[:-1], bounds[1:])])
+        np.testing.assert_array_equal(streamed, expected)
+
+    @unittest.skipUnless(importlib.util.find_spec('mathutils'), "Euler conversion needs mathutils")
+    def test_euler_angles_continue_across_windows(self):
+        for order in ('XYZ', 'ZXY'):
+            expected = rotations_to_eulers(self.rotations, order)
+            continuity = {}
+            bounds = [0, *self.cuts, len(self.rotations)]
+            streamed = np.concatenate([rotations_to_eulers(self.rotations[start:end], order, continuity)
+                                       for start, end in zip(bounds[:-1], bounds[1:])])
+            np.testing.assert_array_equal(streamed, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+# Tests of the background bake job protocol with a Python stand-in for Blender workers,
+# run without Blender by `python -m unittest discover -s tests`
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parallel import run_sample_jobs_steps  # noqa: E402
+
+STAND_IN_WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stand_in_worker.py')
+
+
+def stand_in_launcher(snapshot, job_path):
+    with open(f'{job_path}.log', 'w') as log:
+        return subprocess.Popen([sys.executable, STAND_IN_WORKER, job_path], stdout=log, stderr=subprocess.STDOUT)
+
+
+def failing_launcher(snapshot, job_path):
+    with open(f'{job_path}.log', 'w') as log:
+        return subprocess.Popen([sys.executable, '-c', 'import sys; print("rig missing"); sys.exit(3)'],
+                                stdout=log, stderr=subprocess.STDOUT)
+
+
+def run_steps(steps):
+    progress = []
+    while True:
+        try:
+            progress.append(next(steps))
+        except StopIteration as stop:
+            return stop.value, progress
+
+
+class SampleJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_chunks_merge_in_frame_order(self):
+        frames = np.arange(10, 47)
+        job = {'armature': 'Armature', 'bones': ['a', 'b', 'c']}
+        samples, progress = run_steps(run_sample_jobs_steps(self.directory.name, 'snapshot.blend', job, frames, 4,
+                                                            stand_in_launcher))
+        self.assertEqual(samples.shape, (len(frames), 3, 4, 4))
+        np.testing.assert_array_equal(samples[:, 0, 0, 0], frames)
+        np.testing.assert_array_equal(samples[:, 2, 3, 1], frames)
+        # Waiting yields the frames finished meanwhile, never more than were baked
+        self.assertTrue(all(finished >= 0 for finished in progress))
+        self.assertLessEqual(sum(progress), len(frames))
+
+    def test_failed_job_reports_its_frames_and_log(self):
+        job = {'armature': 'Armature', 'bones': ['a']}
+        with self.assertRaisesRegex(RuntimeError, r'frames 0-4 failed\n.*rig missing'):
+            run_steps(run_sample_jobs_steps(self.directory.name, 'snapshot.blend', job, np.arange(10), 2,
+                                            failing_launcher))
+
+
+if __name__ == "__main__":
+    unittest.main()